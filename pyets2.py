@@ -1,16 +1,31 @@
 # TODO: Try changing most open() calls with mmap.mmap()
 
+import bisect
+import cProfile
+import copy
 import csv
 import functools
+import gc
 import glob
+import io
 import itertools
+import json
 import math
 import mmap
+import operator
 import os.path
+import pstats
 import re
 import struct
 import sys
-from collections import namedtuple, OrderedDict
+import threading
+import time
+import tracemalloc
+import weakref
+import zlib
+from array import array
+from collections import Counter, namedtuple, OrderedDict
+from collections.abc import Mapping
 from enum import IntEnum
 
 IS_PYTHON_3_5 = sys.version_info >= (3, 5)
@@ -28,6 +43,8 @@ if sys.version_info < (3, 4):
 BASE_SCS_DIR = os.path.expanduser('~/ets2/data/base_scs')
 DEF_SCS_DIR = os.path.expanduser('~/ets2/data/def_scs')
 ETS2MAP_LUT_DIR = os.path.expanduser('~/ets2/ets2-map/LUT')
+# Where to cache the parsed LUT files (see Ets2Lut); None disables the cache.
+ETS2MAP_LUT_CACHE_DIR = None
 
 
 ############################################################
@@ -48,6 +65,568 @@ class Vector3(namedtuple('Vector3', 'x y z')):
         return cls(*cls.StructFloats.unpack_from(buffer, offset))
 
 
+class LRUCache:
+    '''Minimal dict-like cache that keeps at most maxsize items.
+
+    Reading or writing an item marks it as the most recently used; when the
+    cache is full, the least recently used item is discarded.
+    '''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __repr__(self):
+        return '<LRUCache {0}/{1} items at {2}>'.format(len(self._data), self.maxsize, hex(id(self)))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def values(self):
+        return self._data.values()
+
+    def clear(self):
+        self._data.clear()
+
+    def copy(self):
+        other = LRUCache(self.maxsize)
+        other._data = self._data.copy()
+        return other
+
+
+def prefab_file_key(filename):
+    '''Returns the key used to match .ppd files to prefab_desc paths: the basename without extension.'''
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+############################################################
+# Reader for *.scs archives.
+#
+# Instead of extracting base.scs and def.scs using scs_extractor, the
+# BASE_SCS_DIR and DEF_SCS_DIR can point directly to the archives, e.g.
+# '~/ets2/base.scs'. Any path that goes "through" a .scs file, such as
+# '~/ets2/base.scs/prefab/car_dealer.ppd', is a virtual path to a file inside
+# the archive, and can be used with open_file() and glob_files().
+#
+# Only the HashFS version 1 format is supported. The layout is:
+#
+#   Header (20 bytes):
+#     char[4] magic = 'SCS#'
+#     uint16 version = 1
+#     uint16 salt
+#     char[4] hash_method = 'CITY'
+#     uint32 entry_count
+#     uint32 entries_offset
+#
+#   Entry (32 bytes), entry_count times, starting at entries_offset:
+#     uint64 hash (CityHash64 of the path, without the leading '/')
+#     uint64 offset
+#     uint32 flags (ScsEntryFlags)
+#     uint32 crc
+#     uint32 size
+#     uint32 compressed_size
+#
+# Directory entries contain the names of their children, one per line;
+# names of subdirectories start with '*'. The root directory has an empty
+# path.
+
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+_CITY_K0 = 0xc3a5c85c97cb3127
+_CITY_K1 = 0xb492b66fbe98f273
+_CITY_K2 = 0x9ae16a3b2f90404f
+_CITY_KMUL = 0x9ddfea08eb382d69
+
+UInt64 = struct.Struct('<Q')
+UInt32 = struct.Struct('<I')
+
+
+def _city_fetch64(s, i):
+    return UInt64.unpack_from(s, i)[0]
+
+
+def _city_fetch32(s, i):
+    return UInt32.unpack_from(s, i)[0]
+
+
+def _city_rotate(val, shift):
+    if shift == 0:
+        return val
+    return ((val >> shift) | (val << (64 - shift))) & _UINT64_MASK
+
+
+def _city_shift_mix(val):
+    return val ^ (val >> 47)
+
+
+def _city_bswap64(val):
+    return int.from_bytes(val.to_bytes(8, 'little'), 'big')
+
+
+def _city_hash_len16(u, v, mul=_CITY_KMUL):
+    a = ((u ^ v) * mul) & _UINT64_MASK
+    a ^= (a >> 47)
+    b = ((v ^ a) * mul) & _UINT64_MASK
+    b ^= (b >> 47)
+    return (b * mul) & _UINT64_MASK
+
+
+def _city_hash_len0to16(s):
+    n = len(s)
+    if n >= 8:
+        mul = _CITY_K2 + n * 2
+        a = (_city_fetch64(s, 0) + _CITY_K2) & _UINT64_MASK
+        b = _city_fetch64(s, n - 8)
+        c = (_city_rotate(b, 37) * mul + a) & _UINT64_MASK
+        d = ((_city_rotate(a, 25) + b) * mul) & _UINT64_MASK
+        return _city_hash_len16(c, d, mul)
+    if n >= 4:
+        mul = _CITY_K2 + n * 2
+        a = _city_fetch32(s, 0)
+        return _city_hash_len16((n + (a << 3)) & _UINT64_MASK, _city_fetch32(s, n - 4), mul)
+    if n > 0:
+        y = s[0] + (s[n >> 1] << 8)
+        z = n + (s[n - 1] << 2)
+        return (_city_shift_mix(((y * _CITY_K2) ^ (z * _CITY_K0)) & _UINT64_MASK) * _CITY_K2) & _UINT64_MASK
+    return _CITY_K2
+
+
+def _city_hash_len17to32(s):
+    n = len(s)
+    mul = _CITY_K2 + n * 2
+    a = (_city_fetch64(s, 0) * _CITY_K1) & _UINT64_MASK
+    b = _city_fetch64(s, 8)
+    c = (_city_fetch64(s, n - 8) * mul) & _UINT64_MASK
+    d = (_city_fetch64(s, n - 16) * _CITY_K2) & _UINT64_MASK
+    return _city_hash_len16(
+        (_city_rotate((a + b) & _UINT64_MASK, 43) + _city_rotate(c, 30) + d) & _UINT64_MASK,
+        (a + _city_rotate((b + _CITY_K2) & _UINT64_MASK, 18) + c) & _UINT64_MASK,
+        mul)
+
+
+def _city_hash_len33to64(s):
+    M = _UINT64_MASK
+    n = len(s)
+    mul = _CITY_K2 + n * 2
+    a = (_city_fetch64(s, 0) * _CITY_K2) & M
+    b = _city_fetch64(s, 8)
+    c = _city_fetch64(s, n - 24)
+    d = _city_fetch64(s, n - 32)
+    e = (_city_fetch64(s, 16) * _CITY_K2) & M
+    f = (_city_fetch64(s, 24) * 9) & M
+    g = _city_fetch64(s, n - 8)
+    h = (_city_fetch64(s, n - 16) * mul) & M
+    u = (_city_rotate((a + g) & M, 43) + (_city_rotate(b, 30) + c) * 9) & M
+    v = (((a + g) & M) ^ d) + f + 1
+    v &= M
+    w = (_city_bswap64(((u + v) * mul) & M) + h) & M
+    x = (_city_rotate((e + f) & M, 42) + c) & M
+    y = ((_city_bswap64(((v + w) * mul) & M) + g) * mul) & M
+    z = (e + f + c) & M
+    a = (_city_bswap64(((x + z) * mul + y) & M) + b) & M
+    b = (_city_shift_mix(((z + a) * mul + d + h) & M) * mul) & M
+    return (b + x) & M
+
+
+def _city_weak_hash_len32_with_seeds(s, i, a, b):
+    M = _UINT64_MASK
+    w = _city_fetch64(s, i)
+    x = _city_fetch64(s, i + 8)
+    y = _city_fetch64(s, i + 16)
+    z = _city_fetch64(s, i + 24)
+    a = (a + w) & M
+    b = _city_rotate((b + a + z) & M, 21)
+    c = a
+    a = (a + x + y) & M
+    b = (b + _city_rotate(a, 44)) & M
+    return ((a + z) & M, (b + c) & M)
+
+
+def cityhash64(s):
+    '''CityHash64 (version 1.1) of a bytes object, as used by HashFS to index the entries.'''
+    M = _UINT64_MASK
+    n = len(s)
+    if n <= 16:
+        return _city_hash_len0to16(s)
+    if n <= 32:
+        return _city_hash_len17to32(s)
+    if n <= 64:
+        return _city_hash_len33to64(s)
+
+    x = _city_fetch64(s, n - 40)
+    y = (_city_fetch64(s, n - 16) + _city_fetch64(s, n - 56)) & M
+    z = _city_hash_len16((_city_fetch64(s, n - 48) + n) & M, _city_fetch64(s, n - 24))
+    v = _city_weak_hash_len32_with_seeds(s, n - 64, n, z)
+    w = _city_weak_hash_len32_with_seeds(s, n - 32, (y + _CITY_K1) & M, x)
+    x = (x * _CITY_K1 + _city_fetch64(s, 0)) & M
+
+    i = 0
+    remaining = (n - 1) & ~63
+    while remaining:
+        x = (_city_rotate((x + y + v[0] + _city_fetch64(s, i + 8)) & M, 37) * _CITY_K1) & M
+        y = (_city_rotate((y + v[1] + _city_fetch64(s, i + 48)) & M, 42) * _CITY_K1) & M
+        x ^= w[1]
+        y = (y + v[0] + _city_fetch64(s, i + 40)) & M
+        z = (_city_rotate((z + w[0]) & M, 33) * _CITY_K1) & M
+        v = _city_weak_hash_len32_with_seeds(s, i, (v[1] * _CITY_K1) & M, (x + w[0]) & M)
+        w = _city_weak_hash_len32_with_seeds(s, i + 32, (z + w[1]) & M, (y + _city_fetch64(s, i + 16)) & M)
+        z, x = x, z
+        i += 64
+        remaining -= 64
+
+    return _city_hash_len16(
+        (_city_hash_len16(v[0], w[0]) + _city_shift_mix(y) * _CITY_K1 + z) & M,
+        (_city_hash_len16(v[1], w[1]) + x) & M)
+
+
+class ScsReadingException(Exception):
+    pass
+
+
+class ScsEntryFlags(IntEnum):
+    Directory = 0x01
+    Compressed = 0x02
+    Verify = 0x04
+    Encrypted = 0x08
+
+
+class ScsEntry(namedtuple('ScsEntry', 'hash offset flags crc size compressed_size')):
+    # 2x unsigned 64-bit integers, 4x unsigned 32-bit integers, little-endian.
+    Struct = struct.Struct('<QQIIII')
+
+    @property
+    def is_directory(self):
+        return bool(self.flags & ScsEntryFlags.Directory)
+
+    @property
+    def is_compressed(self):
+        return bool(self.flags & ScsEntryFlags.Compressed)
+
+    @property
+    def is_encrypted(self):
+        return bool(self.flags & ScsEntryFlags.Encrypted)
+
+
+class ScsArchive:
+    '''Reads files from a .scs archive, without extracting it.
+
+    The archive is mmap'ed and only the entry table is parsed when opening it.
+    Each file is decompressed when read; small files (up to
+    cache_max_entry_size bytes) are kept in a LRU cache of cache_size items.
+
+    The archive is closed by close(), by the with statement, or else when the
+    object is no longer referenced.
+
+    Sample code:
+
+    with pyets2.ScsArchive(os.path.expanduser('~/ets2/def.scs')) as archive:
+        print(archive.listdir('def/world'))
+        with archive.open('def/world/road_look.sii', 'r') as f:
+            for x in pyets2.sii_file_reader(f):
+                print(x.name)
+    '''
+    # magic, version, salt, hash_method, entry_count, entries_offset
+    StructHeader = struct.Struct('<4sHH4sII')
+
+    def __init__(self, filename, cache_size=256, cache_max_entry_size=64 * 1024):
+        self.filename = filename
+        self.cache_max_entry_size = cache_max_entry_size
+        self._cache = LRUCache(cache_size)
+        self._file = open(filename, 'rb')
+        try:
+            stat = os.fstat(self._file.fileno())
+            self.file_signature = (stat.st_size, stat.st_mtime_ns)
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._finalizer = weakref.finalize(self, self._close_resources, self._mmap, self._file)
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def __repr__(self):
+        return '<ScsArchive filename={0!r} entries={1} at {2}>'.format(self.filename, len(self.entries), hex(id(self)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._finalizer()
+        self._mmap = None
+
+    @staticmethod
+    def _close_resources(m, f):
+        # Must not reference the ScsArchive object, see weakref.finalize().
+        m.close()
+        f.close()
+
+    def is_outdated(self):
+        '''Returns True if the file was modified, replaced or removed since it was opened.'''
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True
+        return (stat.st_size, stat.st_mtime_ns) != self.file_signature
+
+    def _parse(self):
+        m = self._mmap
+        if len(m) < self.StructHeader.size:
+            raise ScsReadingException('File "{0}" is too small to be a .scs archive'.format(self.filename))
+        (
+            magic,
+            self.version,
+            self.salt,
+            self.hash_method,
+            entry_count,
+            entries_offset,
+        ) = self.StructHeader.unpack_from(m, 0)
+
+        if magic != b'SCS#':
+            raise ScsReadingException('File "{0}" is not a .scs archive'.format(self.filename))
+        if self.version != 1:
+            raise ScsReadingException('Unsupported HashFS version {0} in "{1}"'.format(self.version, self.filename))
+        if self.hash_method != b'CITY':
+            raise ScsReadingException('Unsupported hash method {0!r} in "{1}"'.format(self.hash_method, self.filename))
+
+        self.entries = {}  # Dict of int (hash) : ScsEntry
+        for entry in ScsEntry.Struct.iter_unpack(m[entries_offset:entries_offset + entry_count * ScsEntry.Struct.size]):
+            entry = ScsEntry(*entry)
+            self.entries[entry.hash] = entry
+
+    def hash_path(self, path):
+        path = path.strip('/')
+        if self.salt != 0:
+            path = str(self.salt) + path
+        return cityhash64(path.encode('utf-8'))
+
+    def get_entry(self, path):
+        entry = self.entries.get(self.hash_path(path))
+        if entry is None:
+            raise FileNotFoundError('File "{0}" not found in "{1}"'.format(path, self.filename))
+        return entry
+
+    def exists(self, path):
+        return self.hash_path(path) in self.entries
+
+    def isdir(self, path):
+        entry = self.entries.get(self.hash_path(path))
+        return entry is not None and entry.is_directory
+
+    def read(self, path):
+        '''Returns the (decompressed) contents of a file as bytes.'''
+        entry = self.get_entry(path)
+        data = self._cache.get(entry.hash)
+        if data is not None:
+            return data
+
+        if entry.is_encrypted:
+            raise ScsReadingException('File "{0}" is encrypted in "{1}"'.format(path, self.filename))
+        raw = self._mmap[entry.offset:entry.offset + entry.compressed_size]
+        if entry.is_compressed:
+            data = zlib.decompress(raw)
+        else:
+            data = raw
+        if len(data) != entry.size:
+            raise ScsReadingException('Wrong size for "{0}" in "{1}": expected {2}, found {3}'.format(
+                path, self.filename, entry.size, len(data)))
+
+        if entry.size <= self.cache_max_entry_size:
+            self._cache[entry.hash] = data
+        return data
+
+    def open(self, path, mode='rb', encoding='utf-8', newline=None):
+        '''Returns a read-only file object for a file inside the archive.'''
+        f = io.BytesIO(self.read(path))
+        if 'b' in mode:
+            return f
+        return io.TextIOWrapper(f, encoding=encoding, newline=newline)
+
+    def listdir(self, path=''):
+        '''Returns the names inside a directory; names of subdirectories start with '*'.'''
+        entry = self.get_entry(path)
+        if not entry.is_directory:
+            raise NotADirectoryError('"{0}" is not a directory in "{1}"'.format(path, self.filename))
+        return [name for name in self.read(path).decode('utf-8').split('\n') if name]
+
+    def walk(self, path=''):
+        '''Yields the paths of all files (not directories) below path.'''
+        path = path.strip('/')
+        for name in self.listdir(path):
+            if name.startswith('*'):
+                subdir = name[1:]
+                yield from self.walk(path + '/' + subdir if path else subdir)
+            else:
+                yield path + '/' + name if path else name
+
+    def glob(self, pattern):
+        '''Returns the paths of files matching a glob pattern (supports '*', '?' and '**/').'''
+        pattern = pattern.strip('/')
+        regex = ''
+        for part in re.split(r'(\*\*/|\*|\?)', pattern):
+            if part == '**/':
+                regex += '(?:.*/)?'
+            elif part == '*':
+                regex += '[^/]*'
+            elif part == '?':
+                regex += '[^/]'
+            else:
+                regex += re.escape(part)
+        regex = re.compile(regex + '$')
+
+        # Starting at the deepest directory without wildcards.
+        base = pattern[:min((pattern.find(c) for c in '*?' if c in pattern), default=len(pattern))]
+        base = base.rpartition('/')[0]
+        if not self.isdir(base):
+            return []
+        return [path for path in self.walk(base) if regex.match(path)]
+
+
+def write_scs_archive(filename, files, compress=True, salt=0):
+    '''Writes a HashFS version 1 .scs archive, given a dict of path : bytes.
+
+    All parent directories are created automatically. Useful to build
+    synthetic archives for testing.
+    '''
+    directories = {'': set()}
+    for path in files:
+        parts = path.strip('/').split('/')
+        for i in range(len(parts)):
+            parent = '/'.join(parts[:i])
+            directories.setdefault(parent, set())
+            if i < len(parts) - 1:
+                directories[parent].add('*' + parts[i])
+            else:
+                directories[parent].add(parts[i])
+
+    contents = []  # List of (path, flags, bytes)
+    for path, names in directories.items():
+        contents.append((path, ScsEntryFlags.Directory, '\n'.join(sorted(names)).encode('utf-8')))
+    for path, data in files.items():
+        contents.append((path.strip('/'), 0, data))
+
+    hash_path = lambda path: cityhash64(((str(salt) if salt else '') + path).encode('utf-8'))
+    entries_offset = ScsArchive.StructHeader.size
+    offset = entries_offset + len(contents) * ScsEntry.Struct.size
+
+    entries = []
+    blobs = []
+    for path, flags, data in contents:
+        stored = data
+        if compress and len(data) > 0:
+            stored = zlib.compress(data)
+            flags |= ScsEntryFlags.Compressed
+        entries.append(ScsEntry(hash_path(path), offset, flags, zlib.crc32(data), len(data), len(stored)))
+        blobs.append(stored)
+        offset += len(stored)
+
+    with open(filename, 'wb') as f:
+        f.write(ScsArchive.StructHeader.pack(b'SCS#', 1, salt, b'CITY', len(entries), entries_offset))
+        for entry in sorted(entries, key=lambda e: e.hash):
+            f.write(ScsEntry.Struct.pack(*entry))
+        for blob in blobs:
+            f.write(blob)
+
+
+_scs_archives = {}  # Dict of str (filename) : ScsArchive
+
+
+def get_scs_archive(filename):
+    '''Returns the shared ScsArchive for a .scs file, opening it again if the file has changed.'''
+    archive = _scs_archives.get(filename)
+    if archive is None or archive.is_outdated():
+        # The old object is not closed here, because other threads (or
+        # Ets2Mapper objects, see Ets2Mapper.scs_archives) may still be
+        # reading from it. It is closed once nothing references it.
+        archive = _scs_archives[filename] = ScsArchive(filename)
+    return archive
+
+
+def find_scs_archive(filename):
+    '''Given a path, returns (filename of the .scs archive, path inside the archive), or (None, filename) for regular files.'''
+    if '.scs' not in filename or os.path.exists(filename):
+        return (None, filename)
+
+    head = filename
+    tail = ''
+    while True:
+        head, sep, rest = head.rpartition('/')
+        if not sep:
+            return (None, filename)
+        tail = rest + ('/' + tail if tail else '')
+        if head.endswith('.scs') and os.path.isfile(head):
+            return (head, tail)
+
+
+def split_scs_path(filename):
+    '''Given a path, returns (ScsArchive, path inside the archive), or (None, filename) for regular files.'''
+    archive_filename, path = find_scs_archive(filename)
+    if archive_filename is None:
+        return (None, filename)
+    return (get_scs_archive(archive_filename), path)
+
+
+def open_file(filename, mode='r', newline=None):
+    '''Like open(), but also works for files inside .scs archives.'''
+    archive, path = split_scs_path(filename)
+    if archive is None:
+        return open(filename, mode, newline=newline)
+    return archive.open(path, mode, newline=newline)
+
+
+def glob_files(pattern):
+    '''Like glob.glob(), but also works for files inside .scs archives.'''
+    archive, path = split_scs_path(pattern)
+    if archive is None:
+        if IS_PYTHON_3_5:
+            return glob.glob(pattern, recursive=True)
+        return glob.glob(pattern)
+    prefix = pattern[:len(pattern) - len(path)]
+    return [prefix + x for x in archive.glob(path)]
+
+
+def file_exists(filename):
+    '''Like os.path.isfile(), but also works for files inside .scs archives.'''
+    archive, path = split_scs_path(filename)
+    if archive is None:
+        return os.path.isfile(filename)
+    return archive.exists(path) and not archive.isdir(path)
+
+
+def file_size(filename):
+    '''Like os.path.getsize(), but also works for files inside .scs archives.'''
+    archive, path = split_scs_path(filename)
+    if archive is None:
+        return os.path.getsize(filename)
+    return archive.get_entry(path).size
+
+
 ############################################################
 # Parser for *.sii text files.
 
@@ -67,7 +646,9 @@ class SiiDefinition:
 
 
 def sii_file_reader(f):
-    '''Given a file (opened as text), returns a generator for items in the .sii file.
+    '''Given a file (opened as text) or a filename, returns a generator for items in the .sii file.
+
+    The filename may be a path inside a .scs archive (see split_scs_path()).
 
     Sample code:
 
@@ -87,6 +668,11 @@ def sii_file_reader(f):
     block_start_re = re.compile('^([^ \t]+)[ \t]*:[ \t]*([^ \t]+)[ \t]*{$')
     block_item_re = re.compile('^([^ \t]+)[ \t]*:[ \t]*([^ \t]+|"[^"]*")$')
 
+    if isinstance(f, str):
+        with open_file(f) as opened:
+            yield from sii_file_reader(opened)
+        return
+
     for lineno, line in enumerate(f, start=1):
         line = line.strip()
 
@@ -151,6 +737,401 @@ def sii_file_reader(f):
         raise SiiReadingException('This should not have happened! line {0}'.format(lineno))
 
 
+############################################################
+# Typed lookup tables, loaded from LUT*.csv files.
+#
+# The LUT files map hexadecimal ids (64 bits) to names. Instead of a dict of
+# Python ints and strs, Ets2Lut keeps the ids in a sorted array of uint64 and,
+# for each id, the index (uint32) of its value in a table of unique values.
+# Lookups use binary search.
+#
+# Loading avoids per-row Python code: the whole file is split at once, the
+# ids are converted by map(int, ...) straight into an array, and the sorting
+# is done by numpy (if installed, and for large tables) or by a single sort
+# of (id << bits | value index) ints. Sorting large tables without numpy
+# would be slower than building a dict, so in that case _DictLut (the same
+# interface, backed by a dict) is used instead.
+#
+# If ETS2MAP_LUT_CACHE_DIR is set, each parsed LUT is also saved there in a
+# binary format, which is memory-mapped (instead of parsed) the next time, as
+# long as the size and mtime of the .csv file have not changed. The layout
+# (little-endian, all sections aligned to 8 bytes) is:
+#
+#   char[8] magic = 'ETS2LUT2'
+#   uint64 csv_size, csv_mtime_ns, count, value_count, values_size, duplicates_size
+#   uint64 ids[count]
+#   uint32 value_indexes[count] (padded to 8 bytes)
+#   uint64 value_offsets[value_count + 1]
+#   char values[values_size] (UTF-8, concatenated)
+#   char duplicates[duplicates_size] (JSON list of [id, [values]])
+
+class Ets2Lut(Mapping):
+    '''Read-only mapping of int id : value, stored as typed arrays.
+
+    Sample code:
+
+    cities = pyets2.Ets2Lut.from_csv(os.path.join(pyets2.ETS2MAP_LUT_DIR, 'LUT1.19-cities.csv'), 0, 1)
+    cities[0x1234]
+    cities.duplicates  # List of (id, list of values) for ids found more than once.
+    '''
+    CacheMagic = b'ETS2LUT2'
+    CacheHeader = struct.Struct('<8s6Q')
+
+    # Tables smaller than this are sorted without numpy (not worth importing
+    # it). Larger ones are kept in a _DictLut if numpy is not installed.
+    NUMPY_MIN_SIZE = 50000
+
+    def __init__(self, ids, value_indexes, values, duplicates=()):
+        self.ids = ids  # Sorted sequence of uint64 (array or memoryview)
+        self.value_indexes = value_indexes  # Sequence of uint32, index into values
+        self.values = values  # List of unique values
+        self.duplicates = list(duplicates)  # List of (id, list of values)
+
+    def __repr__(self):
+        return '<Ets2Lut {0} ids, {1} values at {2}>'.format(len(self.ids), len(self.values), hex(id(self)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, key):
+        i = bisect.bisect_left(self.ids, key)
+        if i == len(self.ids) or self.ids[i] != key:
+            raise KeyError(key)
+        return self.values[self.value_indexes[i]]
+
+    def items(self):
+        values = self.values
+        return zip(self.ids, (values[i] for i in self.value_indexes))
+
+    def with_values(self, mapping):
+        '''Returns a new Ets2Lut sharing the ids, with each value v replaced by mapping[v].'''
+        return Ets2Lut(self.ids, self.value_indexes, [mapping[v] for v in self.values], self.duplicates)
+
+    @classmethod
+    def from_columns(cls, id_strings, values):
+        '''Builds the table from a list of hexadecimal ids and a list of values; for repeated ids, the last one wins.
+
+        Raises ValueError if any id is not a valid hexadecimal number, or does
+        not fit in 64 bits.
+        '''
+        table = list(map(sys.intern, dict.fromkeys(values)))
+        value_to_index = {v: i for i, v in enumerate(table)}
+        try:
+            ids = array('Q', map(int, id_strings, itertools.repeat(16)))
+        except OverflowError as e:
+            raise ValueError('Id out of the uint64 range: {0}'.format(e))
+        value_indexes = array('I', map(value_to_index.__getitem__, values))
+
+        if all(map(operator.lt, ids, itertools.islice(ids, 1, None))):
+            # Already sorted, without repeated ids.
+            return cls(ids, value_indexes, table)
+
+        if len(ids) >= cls.NUMPY_MIN_SIZE:
+            try:
+                import numpy
+            except ImportError:
+                return _DictLut.from_arrays(ids, value_indexes, table)
+            return cls._sort_numpy(numpy, ids, value_indexes, table)
+
+        # A single sort of plain ints, each one being the id followed by its
+        # value index. Repeated ids would end up sorted by value instead of by
+        # file order, so those need the slower, stable sort.
+        shift = max(len(table) - 1, 1).bit_length()
+        composite = sorted(map(operator.or_, map(operator.lshift, ids, itertools.repeat(shift)), value_indexes))
+        sorted_ids = array('Q', map(operator.rshift, composite, itertools.repeat(shift)))
+        if all(map(operator.lt, sorted_ids, itertools.islice(sorted_ids, 1, None))):
+            sorted_indexes = array('I', map(operator.and_, composite, itertools.repeat((1 << shift) - 1)))
+            return cls(sorted_ids, sorted_indexes, table)
+        return cls._sort_stable(ids, value_indexes, table)
+
+    @classmethod
+    def _sort_numpy(cls, numpy, ids, value_indexes, values):
+        np_ids = numpy.frombuffer(ids, dtype=numpy.uint64)
+        np_indexes = numpy.frombuffer(value_indexes, dtype=numpy.uint32)
+
+        # The (faster) unstable sort is enough, unless there are repeated ids.
+        order = numpy.argsort(np_ids, kind='quicksort')
+        ids = np_ids[order]
+        last = numpy.ones(len(ids), dtype=bool)
+        last[:-1] = ids[1:] != ids[:-1]
+        if not last.all():
+            order = numpy.argsort(np_ids, kind='stable')
+            ids = np_ids[order]
+        value_indexes = np_indexes[order]
+
+        # Keeping only the last of each run of equal ids.
+        duplicates = []
+        if not last.all():
+            for idx in numpy.unique(ids[~last]):
+                start = numpy.searchsorted(ids, idx, side='left')
+                end = numpy.searchsorted(ids, idx, side='right')
+                duplicates.append((int(idx), [values[i] for i in value_indexes[start:end].tolist()]))
+            ids = ids[last]
+            value_indexes = value_indexes[last]
+
+        sorted_ids = array('Q')
+        sorted_ids.frombytes(ids.tobytes())
+        sorted_indexes = array('I')
+        sorted_indexes.frombytes(value_indexes.tobytes())
+        return cls(sorted_ids, sorted_indexes, values, duplicates)
+
+    @classmethod
+    def _sort_stable(cls, ids, value_indexes, values):
+        # Sorting by id (stable, so repeated ids keep the file order), then
+        # keeping only the last of each run of equal ids.
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        sorted_ids = array('Q')
+        sorted_indexes = array('I')
+        duplicates = []
+        previous = None
+        for i in order:
+            idx = ids[i]
+            if idx == previous:
+                if not duplicates or duplicates[-1][0] != idx:
+                    duplicates.append((idx, [values[sorted_indexes[-1]]]))
+                duplicates[-1][1].append(values[value_indexes[i]])
+                sorted_indexes[-1] = value_indexes[i]
+            else:
+                sorted_ids.append(idx)
+                sorted_indexes.append(value_indexes[i])
+                previous = idx
+        return cls(sorted_ids, sorted_indexes, values, duplicates)
+
+    @classmethod
+    def from_rows(cls, rows, id_column, value_column, skip_invalid=False):
+        '''Builds the table from rows (lists of str); for repeated ids, the last row wins.'''
+        id_strings = []
+        values = []
+        for row in rows:
+            if not row:
+                continue
+            try:
+                idx = row[id_column]
+                value = row[value_column]
+                if skip_invalid and not 0 <= int(idx, 16) <= _UINT64_MASK:
+                    continue
+            except (ValueError, IndexError):
+                if skip_invalid:
+                    continue
+                raise
+            id_strings.append(idx)
+            values.append(value)
+        return cls.from_columns(id_strings, values)
+
+    @staticmethod
+    def _split_columns(text, id_column, value_column):
+        '''Splits a simple CSV text (no quotes, no blank lines, same number of fields in all lines) into two columns.
+
+        Returns None if the text is not that simple.
+        '''
+        if not text or '"' in text or '\r' in text or '\n\n' in text or text.startswith('\n'):
+            return None
+        if not text.endswith('\n'):
+            text += '\n'
+        columns = text.count(',', 0, text.find('\n')) + 1
+        if text.count(',') != (columns - 1) * text.count('\n') or max(id_column, value_column) >= columns:
+            return None
+        fields = text.replace('\n', ',').split(',')
+        fields.pop()  # After the last '\n'.
+        return fields[id_column::columns], fields[value_column::columns]
+
+    @staticmethod
+    def _strip_header(text, id_column):
+        '''Removes the first line of a CSV text if its id column is not a hexadecimal number (i.e. a header).'''
+        end = text.find('\n')
+        fields = text[:end if end >= 0 else len(text)].split(',')
+        try:
+            int(fields[id_column], 16)
+        except (ValueError, IndexError):
+            return text[end + 1:] if end >= 0 else ''
+        return text
+
+    @classmethod
+    def from_csv(cls, filename, id_column, value_column, skip_invalid=False, cache_dir=None):
+        '''Loads a LUT*.csv file (or its cache, see ETS2MAP_LUT_CACHE_DIR).'''
+        if cache_dir is None:
+            cache_dir = ETS2MAP_LUT_CACHE_DIR
+        stat = os.stat(filename)
+
+        cache_filename = None
+        if cache_dir is not None:
+            cache_filename = os.path.join(cache_dir, '{0}.{1}-{2}.lut'.format(
+                os.path.basename(filename), id_column, value_column))
+            lut = cls.load_cache(cache_filename, stat)
+            if lut is not None:
+                return lut
+
+        with open(filename, 'rb') as f:
+            text = f.read().decode('utf-8')
+
+        # Only lists of str are created here, so there is nothing for the
+        # garbage collector to find, but it would run many times.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            lut = None
+            if skip_invalid:
+                text = cls._strip_header(text, id_column)
+            columns = cls._split_columns(text, id_column, value_column)
+            if columns is not None:
+                try:
+                    lut = cls.from_columns(*columns)
+                except ValueError:
+                    if not skip_invalid:
+                        raise
+            if lut is None:
+                # Quoted fields need the real csv parser, and invalid rows
+                # (such as a header) need to be skipped one by one.
+                if '"' in text:
+                    rows = csv.reader(io.StringIO(text, newline=''))
+                else:
+                    rows = (line.split(',') for line in text.splitlines() if line)
+                lut = cls.from_rows(rows, id_column, value_column, skip_invalid)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        if cache_filename is not None:
+            lut.save_cache(cache_filename, stat)
+        return lut
+
+    def save_cache(self, filename, stat):
+        '''Saves the table (only if all values are str), tagged with the size and mtime of the .csv file.'''
+        if not all(isinstance(v, str) for v in self.values):
+            raise TypeError('Only tables of str values can be cached')
+        encoded = [v.encode('utf-8') for v in self.values]
+        offsets = array('Q', [0])
+        for b in encoded:
+            offsets.append(offsets[-1] + len(b))
+        indexes = array('I', self.value_indexes)
+        if len(indexes) % 2:
+            indexes.append(0)
+        ids = array('Q', self.ids)
+        for a in (ids, indexes, offsets):
+            if sys.byteorder != 'little':
+                a.byteswap()
+        duplicates = json.dumps(self.duplicates).encode('utf-8')
+
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.CacheHeader.pack(
+                self.CacheMagic, stat.st_size, stat.st_mtime_ns, len(self.ids), len(self.values), offsets[-1],
+                len(duplicates)))
+            f.write(ids.tobytes())
+            f.write(indexes.tobytes())
+            f.write(offsets.tobytes())
+            f.write(b''.join(encoded))
+            f.write(duplicates)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load_cache(cls, filename, stat):
+        '''Memory-maps a cache file; returns None if missing, outdated or broken.'''
+        if sys.byteorder != 'little':
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Missing, unreadable or empty.
+            return None
+
+        try:
+            magic, csv_size, csv_mtime, count, value_count, values_size, duplicates_size = cls.CacheHeader.unpack_from(m, 0)
+            if magic != cls.CacheMagic or csv_size != stat.st_size or csv_mtime != stat.st_mtime_ns:
+                raise ValueError('Outdated cache')
+            ids_offset = cls.CacheHeader.size
+            indexes_offset = ids_offset + 8 * count
+            offsets_offset = indexes_offset + 4 * (count + count % 2)
+            values_offset = offsets_offset + 8 * (value_count + 1)
+            duplicates_offset = values_offset + values_size
+            if duplicates_offset + duplicates_size != len(m):
+                raise ValueError('Truncated cache')
+
+            value_offsets = array('Q')
+            value_offsets.frombytes(m[offsets_offset:values_offset])
+            blob = m[values_offset:duplicates_offset]
+            values = [
+                sys.intern(blob[value_offsets[i]:value_offsets[i + 1]].decode('utf-8'))
+                for i in range(value_count)
+            ]
+            duplicates = [
+                (idx, dup_values)
+                for idx, dup_values in json.loads(m[duplicates_offset:].decode('utf-8'))
+            ]
+        except (ValueError, TypeError, struct.error):
+            # ValueError also covers UnicodeDecodeError and invalid JSON.
+            m.close()
+            return None
+
+        # Only the two large arrays are used straight from the mmap.
+        view = memoryview(m)
+        ids = view[ids_offset:indexes_offset].cast('Q')
+        value_indexes = view[indexes_offset:indexes_offset + 4 * count].cast('I')
+        return cls(ids, value_indexes, values, duplicates)
+
+
+class _DictLut(Ets2Lut):
+    '''Ets2Lut backed by a dict of int id : value index, used for large tables if numpy is not installed.
+
+    Building the dict is faster than sorting the ids in Python, but it uses
+    several times more memory. The sorted ids and value_indexes are only built
+    when needed (e.g. by save_cache()).
+    '''
+
+    def __init__(self, mapping, values, duplicates=()):
+        self.mapping = mapping  # Dict of int (id) : int (index into values)
+        self.values = values  # List of unique values
+        self.duplicates = list(duplicates)  # List of (id, list of values)
+
+    @classmethod
+    def from_arrays(cls, ids, value_indexes, values):
+        '''Builds the table from unsorted ids and value indexes; for repeated ids, the last one wins.'''
+        mapping = dict(zip(ids, value_indexes))
+        duplicates = []
+        if len(mapping) != len(ids):
+            repeated = {idx: [] for idx, count in Counter(ids).items() if count > 1}
+            for idx, i in zip(ids, value_indexes):
+                if idx in repeated:
+                    repeated[idx].append(values[i])
+            duplicates = sorted(repeated.items())
+        return cls(mapping, values, duplicates)
+
+    def __repr__(self):
+        return '<_DictLut {0} ids, {1} values at {2}>'.format(len(self.mapping), len(self.values), hex(id(self)))
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def __iter__(self):
+        return iter(self.mapping)
+
+    def __contains__(self, key):
+        return key in self.mapping
+
+    def __getitem__(self, key):
+        return self.values[self.mapping[key]]
+
+    def items(self):
+        values = self.values
+        return ((idx, values[i]) for idx, i in self.mapping.items())
+
+    def with_values(self, mapping):
+        return _DictLut(self.mapping, [mapping[v] for v in self.values], self.duplicates)
+
+    @property
+    def ids(self):
+        return array('Q', sorted(self.mapping))
+
+    @property
+    def value_indexes(self):
+        return array('I', map(self.mapping.__getitem__, sorted(self.mapping)))
+
+
 ############################################################
 # ETS2 objects.
 
@@ -228,91 +1209,95 @@ class Ets2Prefab:
             self.idx, self.idsii, self.filename, hex(id(self)))
 
     def is_file(self, filename):
-        return(
-            os.path.splitext(os.path.basename(self.filename))[0]
-            ==
-            os.path.splitext(os.path.basename(filename))[0]
-        )
+        return prefab_file_key(self.filename) == prefab_file_key(filename)
 
     def parse(self):
+        archive, path = split_scs_path(self.filename)
+        if archive is not None:
+            self.parse_buffer(archive.read(path))
+            return
         with open(self.filename, 'rb') as f:
             with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
-                (
-                    version,    # offset=0
-                    nodes,      # offset=4
-                    navCurves,  # offset=8
-                    terrain,    # offset=12
-                    signs,      # offset=16
-                    spawns,     # offset=20
-                    semaphores, # offset=24
-                    mappoints,  # offset=28
-                    triggers,   # offset=32
-                    intersections, # offset=36
-                    unknown1,   # offset=40
-                    nodeOffset, # offset=44
-                    off2,       # offset=48
-                    off3,       # offset=52
-                    off4,       # offset=56
-                ) = self.StructHeader.unpack_from(m, 0)
-
-                assert version == 21
-
-                for navCurve in range(navCurves):
-                    curveOff = off2 + navCurve * 128
-                    nextCurve = [
-                        Int32_unpack_from(m, 76 + k * 4 + curveOff)
-                        for k in range(4)
-                    ]
-                    prevCurve = [
-                        Int32_unpack_from(m, 92 + k * 4 + curveOff)
-                        for k in range(4)
-                    ]
-                    curve = Ets2PrefabCurve(
-                        index = navCurve,
-                        start          = Vector3.unpack_from(m, 16 + curveOff),
-                        end            = Vector3.unpack_from(m, 28 + curveOff),
-                        start_rotation = Vector3.unpack_from(m, 40 + curveOff),
-                        end_rotation   = Vector3.unpack_from(m, 52 + curveOff),
-                        start_yaw = math.atan2(
-                            Float_unpack_from(m, 48 + curveOff),
-                            Float_unpack_from(m, 40 + curveOff),
-                        ),
-                        end_yaw = math.atan2(
-                            Float_unpack_from(m, 60 + curveOff),
-                            Float_unpack_from(m, 52 + curveOff),
-                        ),
-                        length = Float_unpack_from(m, 72 + curveOff),
-                        next = [i for i in nextCurve if i != -1],
-                        prev = [i for i in prevCurve if i != -1],
-                    )
-                    self.curves.append(curve)
-
-                for curve in self.curves:
-                    curve.next_curve = [self.curves[i] for i in curve.next]
-                    curve.prev_curve = [self.curves[i] for i in curve.prev]
-
-                for node in range(nodes):
-                    nodeOff = nodeOffset + 104 * node
-                    inputLanes = [
-                        Int32_unpack_from(m, 40 + k * 4 + nodeOff)
-                        for k in range(4)
-                    ]
-                    outputLanes = [
-                        Int32_unpack_from(m, 40 + k * 4 + nodeOff)
-                        for k in range(4)
-                    ]
-                    prefabNode = Ets2PrefabNode(
-                        node = node,
-                        coord    = Vector3.unpack_from(m, 16 + nodeOff),
-                        rotation = Vector3.unpack_from(m, 28 + nodeOff),
-                        input_curve  = [self.curves[x] for x in inputLanes if x != -1],
-                        output_curve = [self.curves[x] for x in outputLanes if x != -1],
-                        yaw = math.pi - math.atan2(
-                            Float_unpack_from(m, 36 + nodeOff),
-                            Float_unpack_from(m, 28 + nodeOff),
-                        ),
-                    )
-                    self.nodes.append(prefabNode)
+                self.parse_buffer(m)
+
+    def parse_buffer(self, m):
+        '''Parses the contents of a .ppd file, given as bytes or mmap.'''
+        (
+            version,    # offset=0
+            nodes,      # offset=4
+            navCurves,  # offset=8
+            terrain,    # offset=12
+            signs,      # offset=16
+            spawns,     # offset=20
+            semaphores, # offset=24
+            mappoints,  # offset=28
+            triggers,   # offset=32
+            intersections, # offset=36
+            unknown1,   # offset=40
+            nodeOffset, # offset=44
+            off2,       # offset=48
+            off3,       # offset=52
+            off4,       # offset=56
+        ) = self.StructHeader.unpack_from(m, 0)
+
+        assert version == 21
+
+        for navCurve in range(navCurves):
+            curveOff = off2 + navCurve * 128
+            nextCurve = [
+                Int32_unpack_from(m, 76 + k * 4 + curveOff)
+                for k in range(4)
+            ]
+            prevCurve = [
+                Int32_unpack_from(m, 92 + k * 4 + curveOff)
+                for k in range(4)
+            ]
+            curve = Ets2PrefabCurve(
+                index = navCurve,
+                start          = Vector3.unpack_from(m, 16 + curveOff),
+                end            = Vector3.unpack_from(m, 28 + curveOff),
+                start_rotation = Vector3.unpack_from(m, 40 + curveOff),
+                end_rotation   = Vector3.unpack_from(m, 52 + curveOff),
+                start_yaw = math.atan2(
+                    Float_unpack_from(m, 48 + curveOff),
+                    Float_unpack_from(m, 40 + curveOff),
+                ),
+                end_yaw = math.atan2(
+                    Float_unpack_from(m, 60 + curveOff),
+                    Float_unpack_from(m, 52 + curveOff),
+                ),
+                length = Float_unpack_from(m, 72 + curveOff),
+                next = [i for i in nextCurve if i != -1],
+                prev = [i for i in prevCurve if i != -1],
+            )
+            self.curves.append(curve)
+
+        for curve in self.curves:
+            curve.next_curve = [self.curves[i] for i in curve.next]
+            curve.prev_curve = [self.curves[i] for i in curve.prev]
+
+        for node in range(nodes):
+            nodeOff = nodeOffset + 104 * node
+            inputLanes = [
+                Int32_unpack_from(m, 40 + k * 4 + nodeOff)
+                for k in range(4)
+            ]
+            outputLanes = [
+                Int32_unpack_from(m, 40 + k * 4 + nodeOff)
+                for k in range(4)
+            ]
+            prefabNode = Ets2PrefabNode(
+                node = node,
+                coord    = Vector3.unpack_from(m, 16 + nodeOff),
+                rotation = Vector3.unpack_from(m, 28 + nodeOff),
+                input_curve  = [self.curves[x] for x in inputLanes if x != -1],
+                output_curve = [self.curves[x] for x in outputLanes if x != -1],
+                yaw = math.pi - math.atan2(
+                    Float_unpack_from(m, 36 + nodeOff),
+                    Float_unpack_from(m, 28 + nodeOff),
+                ),
+            )
+            self.nodes.append(prefabNode)
 
     def iterate_curves(self):
         raise NotImplementedError('Look at Ets2Prefab.cs:153')
@@ -381,6 +1366,10 @@ class Ets2Company:
         )
 
 
+# Width of a single lane, in meters.
+LANE_WIDTH = 4.5
+
+
 class Ets2RoadLook:
     _attrs = 'look_id is_highway is_local is_express offset size_left size_right shoulder_left shoulder_right lanes_left lanes_right'.split()
     # Types:
@@ -405,10 +1394,10 @@ class Ets2RoadLook:
         return '<Ets2RoadLook look_id={0!r} at {1}>'.format(self.look_id, hex(id(self)))
 
     def get_total_width(self):
-        return self.offset + 4.5 * (self.lanes_left + self.lanes_right)
+        return self.offset + LANE_WIDTH * (self.lanes_left + self.lanes_right)
 
 
-class Ets2ItemType(IntEnum)
+class Ets2ItemType(IntEnum):
         Building = 0x01
         Road = 0x02
         Prefab = 0x03
@@ -428,118 +1417,771 @@ class Ets2ItemType(IntEnum)
         TrafficRule = 0x25
 
 
-# TODO: Ets2Sector, which requires Ets2Node and Ets2Item.
+class Ets2Sector:
+    # TODO: Ets2Node and Ets2Item, look at Ets2Sector.cs.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.version = None
+        self.nodes = []  # TODO: List of Ets2Node
+        self.items = []  # TODO: List of Ets2Item
+        self.parse()
+
+    def __repr__(self):
+        return '<Ets2Sector filename={0!r} at {1}>'.format(self.filename, hex(id(self)))
+
+    def parse(self):
+        with open_file(self.filename, 'rb') as f:
+            self.version = Int32_unpack_from(f.read(Int32.size))
+
+
+############################################################
+# Instrumentation of the loading phases.
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullInstrumentation:
+    '''Default instrumentation of Ets2Mapper, which does nothing (besides printing warnings).'''
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def count(self, files=0, bytes=0, objects=0):
+        pass
+
+    def warn(self, message, **data):
+        print(message)
+        for key, value in data.items():
+            print('{0}:'.format(key), value)
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class _Phase:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation._exit(self.name)
+        return False
+
+
+class Ets2Instrumentation:
+    '''Collects timings and counts of each loading phase of Ets2Mapper.
+
+    Sample code:
+
+    instrumentation = pyets2.Ets2Instrumentation(trace_memory=True, snapshot_phases=['parse'], hooks=[print])
+    mapper = pyets2.Ets2Mapper(instrumentation=instrumentation)
+    print(instrumentation.report())
+    instrumentation.phases['parse']['snapshot'].statistics('lineno')[:10]
+
+    For each phase name, phases[name] has the number of calls, the total
+    time (including nested phases), the number of files, bytes and objects
+    created and, if trace_memory=True, the difference of traced memory.
+
+    Phases named in snapshot_phases also get a tracemalloc snapshot taken
+    at the end of their latest call. Taking a snapshot is slow (it copies
+    all traces), so avoid the per-file phases ('prefabs' and 'sectors');
+    the time spent taking snapshots is not counted in any phase.
+
+    Each phase start/end and each warning is an event (a dict), which is
+    appended to events (if keep_events=True) and passed to each hook.
+    '''
+    enabled = True
+
+    def __init__(self, trace_memory=False, hooks=(), keep_events=True, print_warnings=True, snapshot_phases=()):
+        self.trace_memory = trace_memory or bool(snapshot_phases)
+        self.snapshot_phases = frozenset(snapshot_phases)
+        self.hooks = list(hooks)
+        self.keep_events = keep_events
+        self.print_warnings = print_warnings
+        self.events = []  # List of dict
+        self.phases = OrderedDict()  # Dict of str : dict
+        self._stack = []  # List of (name, start time, start memory)
+        self._started_tracemalloc = False
+
+    def __repr__(self):
+        return '<Ets2Instrumentation phases={0} events={1} at {2}>'.format(len(self.phases), len(self.events), hex(id(self)))
+
+    def _emit(self, event, **data):
+        data['event'] = event
+        data['time'] = time.perf_counter()
+        if self.keep_events:
+            self.events.append(data)
+        for hook in self.hooks:
+            hook(data)
+
+    def phase(self, name):
+        '''Returns a context manager that measures a phase.'''
+        return _Phase(self, name)
+
+    def _enter(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'calls': 0, 'time': 0.0, 'files': 0, 'bytes': 0, 'objects': 0}
+        memory = 0
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            memory = tracemalloc.get_traced_memory()[0]
+        self._emit('phase_start', phase=name, depth=len(self._stack))
+        self._stack.append((name, time.perf_counter(), memory))
+
+    def _exit(self, name):
+        name, start, memory = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        stats = self.phases[name]
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        if self.trace_memory:
+            stats['memory'] = stats.get('memory', 0) + tracemalloc.get_traced_memory()[0] - memory
+            if name in self.snapshot_phases:
+                snapshot_start = time.perf_counter()
+                stats['snapshot'] = tracemalloc.take_snapshot()
+                # Not counting the snapshot in the time of the enclosing phases.
+                overhead = time.perf_counter() - snapshot_start
+                self._stack = [(n, t + overhead, m) for n, t, m in self._stack]
+            if not self._stack and self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+        self._emit('phase_end', phase=name, depth=len(self._stack), elapsed=elapsed)
+
+    def count(self, files=0, bytes=0, objects=0):
+        '''Adds to the counters of the current (innermost) phase.'''
+        stats = self.phases[self._stack[-1][0]]
+        stats['files'] += files
+        stats['bytes'] += bytes
+        stats['objects'] += objects
+
+    def warn(self, message, **data):
+        if self.print_warnings:
+            NULL_INSTRUMENTATION.warn(message, **data)
+        self._emit('warning', message=message, phase=self._stack[-1][0] if self._stack else None, **data)
+
+    def report(self):
+        '''Returns a human-readable table of all phases.'''
+        lines = ['{0:15s} {1:>7s} {2:>10s} {3:>7s} {4:>12s} {5:>9s}'.format('phase', 'calls', 'time', 'files', 'bytes', 'objects')]
+        for name, stats in self.phases.items():
+            line = '{0:15s} {1[calls]:7d} {1[time]:9.3f}s {1[files]:7d} {1[bytes]:12d} {1[objects]:9d}'.format(name, stats)
+            if 'memory' in stats:
+                line += ' {0:+10.1f}KB'.format(stats['memory'] / 1024)
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def profile_prefab(filename, repeat=100, sort='cumulative'):
+    '''Profiles the parsing of a single .ppd file (repeat times); returns a pstats.Stats.
+
+    Sample code:
+
+    pyets2.profile_prefab(filename).print_stats(20)
+    '''
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for i in range(repeat):
+        Ets2Prefab(filename)
+    profiler.disable()
+    return pstats.Stats(profiler).sort_stats(sort)
 
 
 ############################################################
 # The main class.
 
 class Ets2Mapper:
-    def __init__(self):
-        if IS_PYTHON_3_5:
-            self.prefab_files = glob.glob(
-                os.path.join(BASE_SCS_DIR, 'prefab/**/*.ppd'),
-                recursive=True)
-        else:
-            self.prefab_files = list(itertools.chain(
-                glob.glob(os.path.join(BASE_SCS_DIR, 'prefab/*.ppd')),
-                glob.glob(os.path.join(BASE_SCS_DIR, 'prefab/*/*.ppd')),
-                glob.glob(os.path.join(BASE_SCS_DIR, 'prefab/*/*/*/*.ppd')),
-                glob.glob(os.path.join(BASE_SCS_DIR, 'prefab/*/*/*/*/*.ppd')),
-            ))
+    '''Loads (or lazily loads) all the ETS2 data.
+
+    By default, everything is parsed when the object is created. With
+    lazy=True, only the lists of files are built, and each piece of data is
+    parsed on first access through the get_*() and iter_*() methods:
+
+    mapper = pyets2.Ets2Mapper(lazy=True)
+    mapper.get_road_look('road.look0')  # Parses only road_look.sii and LUT1.19-roads.csv.
+    mapper.get_prefab('prefab.41')      # Parses only the LUTs for prefabs and a single .ppd file.
+    mapper.get_sector(mapper.sector_files[0])
+
+    The most recently used prefabs and sectors are kept in bounded LRU caches
+    (prefab_cache_size and sector_cache_size items).
+
+    Pass an Ets2Instrumentation object to measure each loading phase.
+
+    The get_*(), iter_*() and evict() methods can be called from several
+    threads at once: the on-demand parsing and the cache updates are
+    serialized by a lock.
+    '''
+
+    def __init__(self, lazy=False, prefab_cache_size=1024, sector_cache_size=16, instrumentation=None):
+        self.lazy = lazy
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+
+        # The .scs archives the data is read from, kept open and used by
+        # reload_files() to find out which files have changed inside them.
+        self.scs_archives = self._open_scs_archives()  # Dict of str (filename) : ScsArchive
 
-        self.sector_files = glob.glob(os.path.join(BASE_SCS_DIR, 'map/europe/sec*.base'))
+        with self.instrumentation.phase('glob'):
+            self.prefab_files = self._glob_prefab_files()
+            self.sector_files = self._glob_sector_files()
+            self.instrumentation.count(objects=len(self.prefab_files) + len(self.sector_files))
 
         self.prefabs = []  # List of Ets2Prefab
         self.sectors = []  # List of Ets2Sector
 
         self._companies_lookup = []  # List of Ets2Company
         self._prefab_lookup = {}  # Dict of int (Ets2Prefab.idx) : Ets2Prefab
-        self._cities_lookup = {}  # Dict of int : str
-        self._road_lookup = {}  # Dict of int : Ets2RoadLook
-        self.item_search_requests
+        self._cities_lookup = {}  # Dict (or Ets2Lut) of int : str
+        self._road_lookup = {}  # Dict (or Ets2Lut) of int : Ets2RoadLook
+        self.item_search_requests = []
 
         self.roadlook_by_id = {}  # Dict of str (Ets2RoadLook.look_id) : Ets2RoadLook
 
-        self.parse()
+        # Indexes used to find the data without parsing everything.
+        self._prefab_files_by_key = {}  # Dict of str (prefab_file_key) : list of str (filenames)
+        for filename in self.prefab_files:
+            self._prefab_files_by_key.setdefault(prefab_file_key(filename), []).append(filename)
+        self._idx2prefab = None  # Ets2Lut of int : str (Ets2Prefab.idsii)
+        self._prefab2file = None  # Dict of str (Ets2Prefab.idsii) : str (prefab_desc)
+        self._prefab_ids_by_key = None  # Dict of str (prefab_file_key) : (idx, idsii)
+        self._companies_by_prefab_id = None  # Dict of str (Ets2Company.prefab_id) : Ets2Company
+
+        # Lazily parsed objects.
+        self._prefab_cache = LRUCache(prefab_cache_size)  # filename : Ets2Prefab
+        self._sector_cache = LRUCache(sector_cache_size)  # filename : Ets2Sector
+        self._companies_loaded = False
+        self._cities_loaded = False
+        self._road_looks_loaded = False
+        self._lock = threading.RLock()
+
+        if not lazy:
+            self.parse()
+
+    ########################################
+    # Parsing of each category of data.
+
+    @staticmethod
+    def _open_scs_archives():
+        archives = {}
+        for directory in [BASE_SCS_DIR, DEF_SCS_DIR]:
+            archive_filename = find_scs_archive(os.path.join(directory, ''))[0]
+            if archive_filename is not None:
+                archives[archive_filename] = get_scs_archive(archive_filename)
+        return archives
+
+    @staticmethod
+    def _glob_prefab_files():
+        if IS_PYTHON_3_5:
+            return glob_files(os.path.join(BASE_SCS_DIR, 'prefab/**/*.ppd'))
+        return list(itertools.chain(
+            glob_files(os.path.join(BASE_SCS_DIR, 'prefab/*.ppd')),
+            glob_files(os.path.join(BASE_SCS_DIR, 'prefab/*/*.ppd')),
+            glob_files(os.path.join(BASE_SCS_DIR, 'prefab/*/*/*/*.ppd')),
+            glob_files(os.path.join(BASE_SCS_DIR, 'prefab/*/*/*/*/*.ppd')),
+        ))
+
+    @staticmethod
+    def _glob_sector_files():
+        return glob_files(os.path.join(BASE_SCS_DIR, 'map/europe/sec*.base'))
+
+    @staticmethod
+    def _def_files():
+        return [
+            os.path.join(DEF_SCS_DIR, 'def/world/prefab.sii'),
+            os.path.join(DEF_SCS_DIR, 'def/world/road_look.sii'),
+        ]
+
+    def _count_files(self, *filenames):
+        instrumentation = self.instrumentation
+        if instrumentation.enabled:
+            instrumentation.count(files=len(filenames), bytes=sum(file_size(f) for f in filenames))
+
+    def _load_prefab_index(self):
+        if self._idx2prefab is not None:
+            return
 
-    def loadLUT(self):
-        idx2prefab = {}
         prefab2file = {}
+        lut_filename = os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-prefab.csv')
+        sii_filename = os.path.join(DEF_SCS_DIR, 'def/world/prefab.sii')
+
+        with self.instrumentation.phase('prefab_lut'):
+            self._count_files(lut_filename)
+            # The first row is a header, hence skip_invalid.
+            idx2prefab = Ets2Lut.from_csv(lut_filename, 2, 1, skip_invalid=True)
+            for idx, values in idx2prefab.duplicates:
+                self.instrumentation.warn(
+                    'UNEXPECTED! idx={0} already in idx2prefab.'.format(idx),
+                    values=values)
+            self.instrumentation.count(objects=len(idx2prefab))
+
+        with self.instrumentation.phase('prefab_sii'):
+            self._count_files(sii_filename)
+            with open_file(sii_filename) as f:
+                for block in sii_file_reader(f):
+                    assert block.type == 'prefab_model'
+                    assert block.name not in prefab2file
+                    prefab2file[block.name] = block.items['prefab_desc']
+            self.instrumentation.count(objects=len(prefab2file))
+
+        with self.instrumentation.phase('prefab_join'):
+            prefab_ids_by_key = {}
+            for key, value in idx2prefab.items():
+                if value in prefab2file:
+                    prefab_ids_by_key[prefab_file_key(prefab2file[value])] = (key, value)
+            self.instrumentation.count(objects=len(prefab_ids_by_key))
+
+        self._idx2prefab = idx2prefab
+        self._prefab2file = prefab2file
+        self._prefab_ids_by_key = prefab_ids_by_key
+
+    def _load_companies(self, prefabs_list):
+        if self._companies_loaded:
+            return
+
+        filename = os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-companies.csv')
+        with self.instrumentation.phase('companies'):
+            self._count_files(filename)
+            with open(filename, newline='') as f:
+                reader = csv.reader(f)
+                self._companies_lookup = [Ets2Company.from_csv_line(x, prefabs_list) for x in reader]
+            self._companies_by_prefab_id = {x.prefab_id: x for x in self._companies_lookup}
+            self.instrumentation.count(objects=len(self._companies_lookup))
+        self._companies_loaded = True
+
+    def _load_cities(self):
+        if self._cities_loaded:
+            return
+
+        filename = os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-cities.csv')
+        with self.instrumentation.phase('cities'):
+            self._count_files(filename)
+            self._cities_lookup = Ets2Lut.from_csv(filename, 0, 1)
+            self.instrumentation.count(objects=len(self._cities_lookup))
+        self._cities_loaded = True
+
+    def _load_road_looks(self):
+        if self._road_looks_loaded:
+            return
+
+        sii_filename = os.path.join(DEF_SCS_DIR, 'def/world/road_look.sii')
+        lut_filename = os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-roads.csv')
+
+        with self.instrumentation.phase('road_looks'):
+            self._count_files(sii_filename)
+            with open_file(sii_filename) as f:
+                for block in sii_file_reader(f):
+                    assert block.type == 'road_look'
+                    assert block.name not in self.roadlook_by_id
+                    lanes_left = block.items.get('lanes_left[]', [])
+                    lanes_right = block.items.get('lanes_right[]', [])
+                    lanes_types = set(lanes_left + lanes_right)
+                    self.roadlook_by_id[block.name] = Ets2RoadLook(
+                        look_id = block.name,
+                        is_local = ('traffic_lane.road.local' in lanes_types),
+                        is_highway = ('traffic_lane.road.motorway' in lanes_types),
+                        is_express = ('traffic_lane.road.expressway' in lanes_types),
+                        offset = float(block.items.get('road_offset', 0.0)),
+                        size_left = float(block.items.get('road_size_left', 0.0)),
+                        size_right = float(block.items.get('road_size_right', 0.0)),
+                        shoulder_left = float(block.items.get('shoulder_size_left', 0.0)),
+                        shoulder_right = float(block.items.get('shoulder_size_right', 0.0)),
+                        lanes_left = len(lanes_left),
+                        lanes_right = len(lanes_right),
+                    )
+            self.instrumentation.count(objects=len(self.roadlook_by_id))
+
+        with self.instrumentation.phase('roads_lut'):
+            self._count_files(lut_filename)
+            self._road_lookup = Ets2Lut.from_csv(lut_filename, 0, 1).with_values(self.roadlook_by_id)
+            self.instrumentation.count(objects=len(self._road_lookup))
+        self._road_looks_loaded = True
+
+    def _link_prefabs(self):
+        with self.instrumentation.phase('prefab_link'):
+            prefabs_by_key = {}
+            for prefab in self.prefabs:
+                prefabs_by_key.setdefault(prefab_file_key(prefab.filename), []).append(prefab)
+
+            for key, value in self._idx2prefab.items():
+                if value in self._prefab2file:
+                    filename = self._prefab2file[value]
+                    objs = prefabs_by_key.get(prefab_file_key(filename), [])
+                    if len(objs) > 1:
+                        self.instrumentation.warn('UNEXPECTED! Expected only a single object, found: {0!r}'.format(objs))
+                    elif len(objs) == 1:
+                        obj = objs[0]
+                        obj.idx = key
+                        obj.idsii = value
+                        assert key not in self._prefab_lookup
+                        self._prefab_lookup[key] = obj
+            self.instrumentation.count(objects=len(self._prefab_lookup))
+
+    def _parse_prefab(self, filename):
+        with self.instrumentation.phase('prefabs'):
+            self._count_files(filename)
+            prefab = Ets2Prefab(filename)
+            self.instrumentation.count(objects=1 + len(prefab.curves) + len(prefab.nodes))
+        return prefab
+
+    def _parse_sector(self, filename):
+        with self.instrumentation.phase('sectors'):
+            self._count_files(filename)
+            sector = Ets2Sector(filename)
+            self.instrumentation.count(objects=1)
+        return sector
 
-        with open(os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-prefab.csv'), newline='') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                try:
-                    idx = int(row[2], base=16)
-                except ValueError:
-                    pass
-                else:
-                    if idx in idx2prefab:
-                        print('UNEXPECTED! idx={0} already in idx2prefab.'.format(idx))
-                        print('row:', row)
-                        print('idx2prefab[idx]:', idx2prefab[idx])
-                    idx2prefab[idx] = row[1]
-
-        with open(os.path.join(DEF_SCS_DIR, 'def/world/prefab.sii')) as f:
-            for block in sii_file_reader(f):
-                assert block.type == 'prefab_model'
-                assert block.name not in prefab2file
-                prefab2file[block.name] = block.items['prefab_desc']
-
-        for key, value in idx2prefab.items():
-            if value in prefab2file:
-                filename = prefab2file[value]
-                objs = [x for x in self.prefabs if x.is_file(filename)]
-                if len(objs) > 1:
-                    print('UNEXPECTED! Expected only a single object, found:', objs)
-                elif len(objs) == 1:
-                    obj = objs[0]
-                    obj.idx = key
-                    obj.idsii = value
-                    assert key not in self._prefab_lookup
-                    self._prefab_lookup[key] = obj
-
-        with open(os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-companies.csv'), newline='') as f:
-            reader = csv.reader(f)
-            self._companies_lookup = [Ets2Company.from_csv_line(x, self.prefabs) for x in reader]
-
-        with open(os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-cities.csv'), newline='') as f:
-            reader = csv.reader(f)
-            self._cities_lookup = {int(row[0], base=16): row[1] for row in f}
-
-        with open(os.path.join(DEF_SCS_DIR, 'def/world/road_look.sii')) as f:
-            for block in sii_file_reader(f):
-                assert block.type == 'road_look'
-                assert block.name not in self.roadlook_by_id
-                lanes_left = block.items.get('lanes_left[]', [])
-                lanes_right = block.items.get('lanes_right[]', [])
-                lanes_types = set(lanes_left + lanes_right)
-                self.roadlook_by_id[block.name] = Ets2RoadLook(
-                    look_id = block.name,
-                    is_local = ('traffic_lane.road.local' in lanes_types),
-                    is_highway = ('traffic_lane.road.motorway' in lanes_types),
-                    is_express = ('traffic_lane.road.expressway' in lanes_types),
-                    offset = float(block.items.get('road_offset', 0.0)),
-                    size_left = float(block.items.get('road_size_left', 0.0)),
-                    size_right = float(block.items.get('road_size_right', 0.0)),
-                    shoulder_left = float(block.items.get('shoulder_size_left', 0.0)),
-                    shoulder_right = float(block.items.get('shoulder_size_right', 0.0)),
-                    lanes_left = len(lanes_left),
-                    lanes_right = len(lanes_right),
-                )
-
-        with open(os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-roads.csv'), newline='') as f:
-            reader = csv.reader(f)
-            self._road_lookup = {int(row[0], base=16): self.roadlook_by_id[row[1]] for row in reader}
+    def loadLUT(self):
+        with self.instrumentation.phase('loadLUT'):
+            self._load_prefab_index()
+            self._link_prefabs()
+            self._load_companies(self.prefabs)
+            self._load_cities()
+            self._load_road_looks()
 
     def parse(self):
-        # TODO: "skip multi sectors" parameter
-        self.prefabs = [Ets2Prefab(f) for f in self.prefab_files]
-        self.loadLUT()
-
-        # self.item_search_requests = []
-        self.sectors = [Ets2Sector(f) for f in self.sector_files]
-
-        # TODO: everything else, Ets2Mapper.cs:231
+        with self.instrumentation.phase('parse'):
+            # TODO: "skip multi sectors" parameter
+            self.prefabs = [self._parse_prefab(f) for f in self.prefab_files]
+            self.loadLUT()
+
+            # self.item_search_requests = []
+            self.sectors = [self._parse_sector(f) for f in self.sector_files]
+
+            # TODO: everything else, Ets2Mapper.cs:231
+
+    ########################################
+    # On-demand access, used by lazy mode (but also works after parse()).
+
+    def _find_prefab_file(self, key):
+        '''Given an int idx, an idsii ("prefab.41"), a path or a basename, returns the .ppd filename.'''
+        if isinstance(key, int):
+            self._load_prefab_index()
+            if key not in self._idx2prefab:
+                raise KeyError(key)
+            key = self._idx2prefab[key]
+        elif key in self._prefab_files_by_key.get(prefab_file_key(key), ()):
+            # An exact path, which is fine even if other .ppd files share its basename.
+            return key
+
+        if key in self._prefab_files_by_key:
+            files = self._prefab_files_by_key[key]
+        else:
+            self._load_prefab_index()
+            if key in self._prefab2file:
+                key = self._prefab2file[key]
+            files = self._prefab_files_by_key.get(prefab_file_key(key), [])
+
+        if len(files) != 1:
+            raise KeyError('Expected a single .ppd file for {0!r}, found: {1!r}'.format(key, files))
+        return files[0]
+
+    def get_prefab(self, key):
+        '''Returns the Ets2Prefab for an idx, idsii, path or basename, parsing it if needed.'''
+        with self._lock:
+            filename = self._find_prefab_file(key)
+
+            prefab = self._prefab_cache.get(filename)
+            if prefab is None:
+                if not self.lazy:
+                    prefab = next((x for x in self.prefabs if x.filename == filename), None)
+                if prefab is None:
+                    prefab = self._parse_prefab(filename)
+                    self._load_prefab_index()
+                    key = prefab_file_key(filename)
+                    ids = self._prefab_ids_by_key.get(key)
+                    # Just like _link_prefabs(), ambiguous basenames get no idx.
+                    if ids is not None and len(self._prefab_files_by_key[key]) == 1:
+                        prefab.idx, prefab.idsii = ids
+                self._prefab_cache[filename] = prefab
+
+            # The companies may have been loaded after the prefab was cached.
+            if self._companies_loaded and prefab.company is None and prefab.idsii:
+                prefab.company = self._companies_by_prefab_id.get(prefab.idsii)
+                if prefab.company is not None:
+                    prefab.company.prefab = prefab
+            return prefab
+
+    def iter_prefabs(self):
+        '''Yields all prefabs, parsing them as needed.'''
+        if not self.lazy:
+            yield from self.prefabs
+            return
+        for filename in self.prefab_files:
+            yield self.get_prefab(filename)
+
+    def get_company(self, prefab_id):
+        '''Returns the Ets2Company for a prefab idsii ("prefab.41"), or None.'''
+        with self._lock:
+            if not self._companies_loaded:
+                self._load_companies([])
+            company = self._companies_by_prefab_id.get(prefab_id)
+            if company is not None and company.prefab is None:
+                try:
+                    self.get_prefab(prefab_id)
+                except KeyError:
+                    pass
+            return company
+
+    def iter_companies(self):
+        with self._lock:
+            if not self._companies_loaded:
+                self._load_companies([])
+            return iter(self._companies_lookup)
+
+    def get_city(self, idx):
+        '''Returns the name of the city for an int idx.'''
+        with self._lock:
+            self._load_cities()
+            return self._cities_lookup[idx]
+
+    def iter_cities(self):
+        '''Yields (idx, name) for all cities.'''
+        with self._lock:
+            self._load_cities()
+            return iter(self._cities_lookup.items())
+
+    def get_road_look(self, key):
+        '''Returns the Ets2RoadLook for a look_id ("road.look0") or an int idx.'''
+        with self._lock:
+            self._load_road_looks()
+            if isinstance(key, int):
+                return self._road_lookup[key]
+            return self.roadlook_by_id[key]
+
+    def iter_road_looks(self):
+        with self._lock:
+            self._load_road_looks()
+            return iter(self.roadlook_by_id.values())
+
+    def iter_roads(self):
+        '''Yields (idx, Ets2RoadLook) for all roads in the LUT.'''
+        with self._lock:
+            self._load_road_looks()
+            return iter(self._road_lookup.items())
+
+    def get_sector(self, filename):
+        '''Returns the Ets2Sector for a filename, parsing it if needed.
+
+        In lazy mode, only the most recently used sectors are kept in memory.
+        '''
+        with self._lock:
+            if not self.lazy:
+                for sector in self.sectors:
+                    if sector.filename == filename:
+                        return sector
+
+            sector = self._sector_cache.get(filename)
+            if sector is None:
+                sector = self._parse_sector(filename)
+                self._sector_cache[filename] = sector
+            return sector
+
+    def iter_sectors(self):
+        '''Yields all sectors, parsing them as needed.'''
+        if not self.lazy:
+            yield from self.sectors
+            return
+        for filename in self.sector_files:
+            yield self.get_sector(filename)
+
+    def evict(self, prefabs=False, sectors=True):
+        '''Discards the lazily parsed prefabs and/or sectors, freeing their memory.'''
+        with self._lock:
+            if prefabs:
+                self._prefab_cache.clear()
+            if sectors:
+                self._sector_cache.clear()
+
+    ########################################
+    # Reloading after the files have changed.
+
+    def watched_files(self):
+        '''Returns the list of all files that are parsed by this class.
+
+        The files inside a .scs archive cannot be stat'ed, so the archive
+        itself is listed instead (see reload_files()).
+        '''
+        files = []
+        base_archive = find_scs_archive(os.path.join(BASE_SCS_DIR, ''))[0]
+        if base_archive is not None:
+            files.append(base_archive)
+        else:
+            files.extend(self._glob_prefab_files())
+            files.extend(self._glob_sector_files())
 
+        def_archive = find_scs_archive(os.path.join(DEF_SCS_DIR, ''))[0]
+        if def_archive is not None:
+            if def_archive not in files:
+                files.append(def_archive)
+        else:
+            files.extend(self._def_files())
+
+        return files + [
+            os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-prefab.csv'),
+            os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-companies.csv'),
+            os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-cities.csv'),
+            os.path.join(ETS2MAP_LUT_DIR, 'LUT1.19-roads.csv'),
+        ]
+
+    def copy(self):
+        '''Returns a shallow copy that has its own lists, dicts and caches, but shares the parsed objects.'''
+        other = object.__new__(type(self))
+        with self._lock:
+            other.__dict__.update(self.__dict__)
+            for attr, value in self.__dict__.items():
+                if isinstance(value, (list, dict, LRUCache)):
+                    setattr(other, attr, value.copy())
+        other._lock = threading.RLock()
+        return other
+
+    def _changed_files_in_archive(self, filename):
+        '''Given a .scs archive that has changed, returns (new ScsArchive or None, watched files inside it that were added, modified or removed).'''
+        old_archive = self.scs_archives.get(filename)
+        new_archive = get_scs_archive(filename) if os.path.isfile(filename) else None
+
+        prefix = os.path.join(filename, '')
+        candidates = set(self.prefab_files + self.sector_files + self._def_files())
+        if new_archive is not None:
+            candidates.update(self._glob_prefab_files() + self._glob_sector_files())
+        candidates = sorted(f for f in candidates if f.startswith(prefix))
+
+        if old_archive is None or old_archive is new_archive or new_archive is None:
+            # Without both versions of the archive there is nothing to compare.
+            return new_archive, candidates
+
+        def entry_of(archive, path):
+            entry = archive.entries.get(archive.hash_path(path))
+            return entry and (entry.flags, entry.crc, entry.size)
+
+        return new_archive, [
+            f for f in candidates
+            if entry_of(old_archive, f[len(prefix):]) != entry_of(new_archive, f[len(prefix):])
+        ]
+
+    def reload_files(self, filenames):
+        '''Returns a new Ets2Mapper in which only the given (added, modified or removed) files are parsed again.
+
+        filenames may also include .scs archives (as returned by
+        watched_files()); only the files that changed inside them are parsed
+        again.
+
+        This object is not modified, so it can still be used until the new one
+        replaces it. The parsed objects of files that have not changed are
+        shared between both, except that the Ets2Prefab objects are copied
+        before being linked again to the LUTs and companies.
+        '''
+        expanded = []
+        archives = {}  # Dict of str (filename) : ScsArchive or None
+        for filename in filenames:
+            if filename.endswith('.scs'):
+                archives[filename], changed = self._changed_files_in_archive(filename)
+                expanded.extend(changed)
+            else:
+                expanded.append(filename)
+        filenames = expanded
+
+        new = self.copy()
+        for filename, archive in archives.items():
+            # Replacing the old archive here (but not in this object) lets it be
+            # closed once this object is gone.
+            if archive is None:
+                new.scs_archives.pop(filename, None)
+            else:
+                new.scs_archives[filename] = archive
+        prefabs_changed = False
+        index_changed = False
+        companies_changed = False
+        cities_changed = False
+        road_looks_changed = False
+
+        def update_list(items, filename, exists):
+            if filename in items:
+                items.remove(filename)
+            if exists:
+                items.append(filename)
+
+        for filename in filenames:
+            basename = os.path.basename(filename)
+            exists = file_exists(filename)
+            if filename.endswith('.ppd'):
+                update_list(new.prefab_files, filename, exists)
+                new._prefab_cache.pop(filename)
+                if not new.lazy:
+                    new.prefabs = [x for x in new.prefabs if x.filename != filename]
+                    if exists:
+                        new.prefabs.append(new._parse_prefab(filename))
+                prefabs_changed = True
+            elif filename.endswith('.base'):
+                update_list(new.sector_files, filename, exists)
+                new._sector_cache.pop(filename)
+                if not new.lazy:
+                    new.sectors = [x for x in new.sectors if x.filename != filename]
+                    if exists:
+                        new.sectors.append(new._parse_sector(filename))
+            elif basename in ('prefab.sii', 'LUT1.19-prefab.csv'):
+                index_changed = True
+            elif basename == 'LUT1.19-companies.csv':
+                companies_changed = True
+            elif basename == 'LUT1.19-cities.csv':
+                cities_changed = True
+            elif basename in ('road_look.sii', 'LUT1.19-roads.csv'):
+                road_looks_changed = True
+
+        if prefabs_changed:
+            new._prefab_files_by_key = {}
+            for filename in new.prefab_files:
+                new._prefab_files_by_key.setdefault(prefab_file_key(filename), []).append(filename)
+
+        if index_changed:
+            new._idx2prefab = None
+            new._prefab2file = None
+            new._prefab_ids_by_key = None
+            new._prefab_cache.clear()
+
+        if not new.lazy and (prefabs_changed or index_changed or companies_changed):
+            # Linking modifies the prefabs, which are still being used through this object.
+            new.prefabs = [copy.copy(x) for x in new.prefabs]
+            for prefab in new.prefabs:
+                prefab.idx = 0
+                prefab.idsii = ''
+                prefab.company = None
+            new._prefab_cache.clear()
+            new._load_prefab_index()
+            new._prefab_lookup = {}
+            new._link_prefabs()
+            companies_changed = True
+
+        if companies_changed:
+            new._companies_loaded = False
+            new._companies_lookup = []
+            new._companies_by_prefab_id = None
+            if new.lazy:
+                new._prefab_cache.clear()
+            else:
+                new._load_companies(new.prefabs)
+
+        if cities_changed:
+            new._cities_loaded = False
+            new._cities_lookup = {}
+            if not new.lazy:
+                new._load_cities()
+
+        if road_looks_changed:
+            new._road_looks_loaded = False
+            new.roadlook_by_id = {}
+            new._road_lookup = {}
+            if not new.lazy:
+                new._load_road_looks()
+
+        return new
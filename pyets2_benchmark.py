@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+#
+# Overview:
+#
+#   Benchmarks the pyets2 parsers using synthetic game data, so it can run
+#   anywhere (including CI), without a licensed copy of the game.
+#
+#   Usage:
+#
+#       pyets2_benchmark.py                          # Prints a summary.
+#       pyets2_benchmark.py --json results.json      # Also saves the results.
+#       pyets2_benchmark.py --data-dir /tmp/synthetic --prefabs 5000
+#
+#
+# How it works:
+#
+#   1. Generates, inside a temporary directory (or --data-dir):
+#      - base_scs/prefab/**/*.ppd: version 21 prefabs, with the given number
+#        of curves and nodes each.
+#      - base_scs/map/europe/sec*.base: sector files.
+#      - def_scs/def/world/prefab.sii and road_look.sii.
+#      - LUT/LUT1.19-{prefab,companies,cities,roads}.csv.
+#      The default amounts are similar to the real ETS2 1.19 data.
+#      The parameters are saved in parameters.json, and an existing
+#      --data-dir generated with the same parameters is reused as is. A
+#      --data-dir generated with other parameters is generated again, and any
+#      other non-empty --data-dir is refused (nothing is deleted from it).
+#   2. Points pyets2.BASE_SCS_DIR, DEF_SCS_DIR and ETS2MAP_LUT_DIR to it.
+#   3. Runs each phase (see PHASES) --repeat times, after its (untimed) setup,
+#      and reports the best time, the throughput (files/s, MB/s, objects/s)
+#      and the peak memory (measured with tracemalloc in one extra run, so it
+#      does not affect the timings).
+#
+#   The JSON output includes the current git commit, so results from
+#   different commits can be compared.
+#
+#
+# Requirements:
+#   - Python 3.4
+
+import argparse
+import json
+import math
+import os
+import os.path
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pyets2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark pyets2 parsers using synthetic data.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--prefabs', action='store', default=2500, type=int, dest='prefabs', help='Number of .ppd files')
+    parser.add_argument('--curves', action='store', default=24, type=int, dest='curves', help='Curves per prefab')
+    parser.add_argument('--nodes', action='store', default=4, type=int, dest='nodes', help='Nodes per prefab')
+    parser.add_argument('--road-looks', action='store', default=400, type=int, dest='road_looks', help='Number of road looks')
+    parser.add_argument('--roads', action='store', default=6000, type=int, dest='roads', help='Rows in LUT1.19-roads.csv')
+    parser.add_argument('--companies', action='store', default=1200, type=int, dest='companies', help='Rows in LUT1.19-companies.csv')
+    parser.add_argument('--cities', action='store', default=250, type=int, dest='cities', help='Rows in LUT1.19-cities.csv')
+    parser.add_argument('--sectors', action='store', default=300, type=int, dest='sectors', help='Number of .base files')
+    parser.add_argument('--seed', action='store', default=1, type=int, dest='seed', help='Random seed')
+    parser.add_argument('--repeat', action='store', default=3, type=int, dest='repeat', help='Runs of each phase')
+    parser.add_argument(
+        '--data-dir',
+        action='store',
+        default=None,
+        type=str,
+        dest='data_dir',
+        help='Where to generate (or reuse) the synthetic data (default: a temporary directory)'
+    )
+    parser.add_argument('--json', action='store', default=None, type=str, dest='json', help='Save the results to this file')
+    return parser.parse_args()
+
+
+############################################################
+# Generators of synthetic data.
+
+def generate_ppd(rng, curves, nodes):
+    '''Returns the bytes of a version 21 .ppd file.'''
+    header_size = pyets2.Ets2Prefab.StructHeader.size
+    curves_offset = header_size
+    nodes_offset = curves_offset + 128 * curves
+    data = bytearray(nodes_offset + 104 * nodes)
+    pyets2.Ets2Prefab.StructHeader.pack_into(
+        data, 0,
+        21, nodes, curves, 0, 0, 0, 0, 0, 0, 0, 0,
+        nodes_offset, curves_offset, 0, 0)
+
+    for i in range(curves):
+        offset = curves_offset + 128 * i
+        start = [rng.uniform(-50, 50), rng.uniform(-2, 2), rng.uniform(-50, 50)]
+        end = [rng.uniform(-50, 50), rng.uniform(-2, 2), rng.uniform(-50, 50)]
+        yaw0 = rng.uniform(-3.14, 3.14)
+        yaw1 = rng.uniform(-3.14, 3.14)
+        struct.pack_into('<3f', data, offset + 16, *start)
+        struct.pack_into('<3f', data, offset + 28, *end)
+        struct.pack_into('<3f', data, offset + 40, math.cos(yaw0), 0.0, math.sin(yaw0))
+        struct.pack_into('<3f', data, offset + 52, math.cos(yaw1), 0.0, math.sin(yaw1))
+        struct.pack_into('<f', data, offset + 72, rng.uniform(5, 120))
+        next_curves = rng.sample(range(curves), min(curves, rng.randint(0, 2)))
+        prev_curves = rng.sample(range(curves), min(curves, rng.randint(0, 2)))
+        struct.pack_into('<4i', data, offset + 76, *(next_curves + [-1] * (4 - len(next_curves))))
+        struct.pack_into('<4i', data, offset + 92, *(prev_curves + [-1] * (4 - len(prev_curves))))
+
+    for i in range(nodes):
+        offset = nodes_offset + 104 * i
+        struct.pack_into('<3f', data, offset + 16, rng.uniform(-50, 50), 0.0, rng.uniform(-50, 50))
+        struct.pack_into('<3f', data, offset + 28, rng.uniform(-1, 1), 0.0, rng.uniform(-1, 1))
+        lanes = rng.sample(range(curves), min(curves, rng.randint(1, 4)))
+        struct.pack_into('<4i', data, offset + 40, *(lanes + [-1] * (4 - len(lanes))))
+        lanes = rng.sample(range(curves), min(curves, rng.randint(1, 4)))
+        struct.pack_into('<4i', data, offset + 56, *(lanes + [-1] * (4 - len(lanes))))
+
+    return bytes(data)
+
+
+def write_sii(filename, blocks):
+    '''Writes a .sii file, given a list of (type, name, list of (key, value)).'''
+    with open(filename, 'w') as f:
+        f.write('SiiNunit\n{\n')
+        f.write('# Synthetic data generated by pyets2_benchmark.py\n')
+        for type, name, items in blocks:
+            f.write('{0} : {1} {{\n'.format(type, name))
+            for key, value in items:
+                f.write('\t{0}: {1}\n'.format(key, value))
+            f.write('}\n\n')
+        f.write('}\n')
+
+
+GENERATOR_NAME = 'pyets2_benchmark'
+GENERATOR_PARAMETERS = 'prefabs curves nodes road_looks roads companies cities sectors seed'.split()
+
+
+def generate_game_data(root, options):
+    '''Generates all the synthetic files inside root; returns (base_scs, def_scs, lut) directories.
+
+    If root already has data generated with the same parameters, it is reused.
+    Data generated with other parameters is deleted, but only if parameters.json
+    says it was generated by this script; any other non-empty root is refused.
+    '''
+    base_dir = os.path.join(root, 'base_scs')
+    def_dir = os.path.join(root, 'def_scs')
+    lut_dir = os.path.join(root, 'LUT')
+
+    parameters_filename = os.path.join(root, 'parameters.json')
+    parameters = {k: getattr(options, k) for k in GENERATOR_PARAMETERS}
+    parameters['generator'] = GENERATOR_NAME
+    try:
+        with open(parameters_filename) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    if isinstance(previous, dict) and previous.get('generator') == GENERATOR_NAME:
+        if previous == dict(parameters, complete=True):
+            return base_dir, def_dir, lut_dir
+        # Only the directories generated by this script are ever deleted.
+        for d in [base_dir, def_dir, lut_dir]:
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+    elif os.path.isdir(root) and os.listdir(root):
+        sys.exit('Refusing to generate the synthetic data inside "{0}": it is not empty, '
+                 'and it was not generated by this script'.format(root))
+
+    # Written before anything else (and again at the end), so an interrupted
+    # run is recognized, deleted and generated again.
+    os.makedirs(root, exist_ok=True)
+    with open(parameters_filename, 'w') as f:
+        json.dump(dict(parameters, complete=False), f, indent=2, sort_keys=True)
+
+    rng = random.Random(options.seed)
+    for d in [os.path.join(def_dir, 'def/world'), os.path.join(base_dir, 'map/europe'), lut_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    # Prefabs, spread over a few subdirectories like the real data.
+    categories = ['dlc', 'gas', 'company', 'road', 'cross', 'city', 'parking', 'toll']
+    prefab_blocks = []
+    prefab_rows = []
+    for i in range(options.prefabs):
+        path = 'prefab/{0}/{1:02d}/pf_{2:05d}.ppd'.format(categories[i % len(categories)], i % 37, i)
+        filename = os.path.join(base_dir, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(generate_ppd(rng, options.curves, options.nodes))
+        name = 'pf.{0:05d}'.format(i)
+        prefab_blocks.append(('prefab_model', name, [
+            ('prefab_desc', '"/{0}"'.format(path)),
+            ('model_desc', '"/{0}"'.format(path.replace('.ppd', '.pmd'))),
+            ('category', '"{0}"'.format(categories[i % len(categories)])),
+            ('corner0', '"{0}"'.format('sidewalk')),
+            ('dynamic_lod_desc[]', '"/{0}"'.format(path.replace('.ppd', '_lod1.pmd'))),
+            ('dynamic_lod_distance[]', '120'),
+        ]))
+        prefab_rows.append([path, name, '{0:x}'.format(i + 1)])
+    write_sii(os.path.join(def_dir, 'def/world/prefab.sii'), prefab_blocks)
+
+    with open(os.path.join(lut_dir, 'LUT1.19-prefab.csv'), 'w') as f:
+        f.write('path,name,idx\n')
+        for row in prefab_rows:
+            f.write(','.join(row) + '\n')
+
+    with open(os.path.join(lut_dir, 'LUT1.19-companies.csv'), 'w') as f:
+        for i in range(options.companies):
+            f.write('pf.{0:05d},{1},{2},{3},{4}\n'.format(
+                rng.randrange(options.prefabs), rng.randint(-100, 0), rng.randint(-100, 0), rng.randint(0, 100), rng.randint(0, 100)))
+
+    with open(os.path.join(lut_dir, 'LUT1.19-cities.csv'), 'w') as f:
+        for i in range(options.cities):
+            f.write('{0:x},City{1}\n'.format(0x10000 + i * 7919, i))
+
+    lanes = ['traffic_lane.road.local', 'traffic_lane.road.motorway', 'traffic_lane.road.expressway']
+    look_blocks = []
+    for i in range(options.road_looks):
+        items = [
+            ('name', '"Road {0}"'.format(i)),
+            ('road_size_left', '{0:.1f}'.format(rng.choice([0, 4.5, 9.0, 13.5]))),
+            ('road_size_right', '{0:.1f}'.format(rng.choice([0, 4.5, 9.0, 13.5]))),
+            ('road_offset', '{0:.1f}'.format(rng.choice([0, 0, 2.0, 5.0]))),
+            ('shoulder_size_left', '{0:.1f}'.format(rng.choice([0, 1.0, 2.5]))),
+            ('shoulder_size_right', '{0:.1f}'.format(rng.choice([0, 1.0, 2.5]))),
+        ]
+        lane = rng.choice(lanes)
+        items += [('lanes_left[]', lane)] * rng.randint(0, 3)
+        items += [('lanes_right[]', lane)] * rng.randint(1, 3)
+        look_blocks.append(('road_look', 'road.look{0}'.format(i), items))
+    write_sii(os.path.join(def_dir, 'def/world/road_look.sii'), look_blocks)
+
+    with open(os.path.join(lut_dir, 'LUT1.19-roads.csv'), 'w') as f:
+        for i in range(options.roads):
+            f.write('{0:x},road.look{1}\n'.format(0x100000 + i, rng.randrange(options.road_looks)))
+
+    side = max(1, int(options.sectors ** 0.5))
+    for i in range(options.sectors):
+        filename = os.path.join(base_dir, 'map/europe/sec{0:+05d}{1:+05d}.base'.format(i % side, i // side))
+        with open(filename, 'wb') as f:
+            f.write(struct.pack('<i', 825) + bytes(rng.randint(1000, 20000)))
+
+    with open(parameters_filename, 'w') as f:
+        json.dump(dict(parameters, complete=True), f, indent=2, sort_keys=True)
+
+    return base_dir, def_dir, lut_dir
+
+
+############################################################
+# Phases.
+
+def files_size(filenames):
+    return sum(os.path.getsize(f) for f in filenames)
+
+
+def phase_sii_file_reader():
+    filenames = [
+        os.path.join(pyets2.DEF_SCS_DIR, 'def/world/prefab.sii'),
+        os.path.join(pyets2.DEF_SCS_DIR, 'def/world/road_look.sii'),
+    ]
+    objects = 0
+    for filename in filenames:
+        with open(filename) as f:
+            objects += sum(1 for block in pyets2.sii_file_reader(f))
+    return len(filenames), files_size(filenames), objects
+
+
+def phase_prefab_parse():
+    mapper = pyets2.Ets2Mapper(lazy=True)
+    prefabs = [pyets2.Ets2Prefab(f) for f in mapper.prefab_files]
+    objects = sum(len(p.curves) + len(p.nodes) for p in prefabs)
+    return len(prefabs), files_size(mapper.prefab_files), objects
+
+
+def setup_load_lut():
+    # loadLUT() links the LUTs to the already parsed prefabs (see Ets2Mapper.parse()).
+    return [pyets2.Ets2Prefab(f) for f in pyets2.Ets2Mapper(lazy=True).prefab_files]
+
+
+def phase_load_lut(prefabs):
+    mapper = pyets2.Ets2Mapper(lazy=True)
+    mapper.prefabs = prefabs
+    mapper.loadLUT()
+    filenames = [
+        os.path.join(pyets2.ETS2MAP_LUT_DIR, 'LUT1.19-{0}.csv'.format(x))
+        for x in ['prefab', 'companies', 'cities', 'roads']
+    ] + [
+        os.path.join(pyets2.DEF_SCS_DIR, 'def/world/prefab.sii'),
+        os.path.join(pyets2.DEF_SCS_DIR, 'def/world/road_look.sii'),
+    ]
+    objects = (
+        len(mapper._prefab_lookup) + len(mapper._companies_lookup) + len(mapper._cities_lookup) +
+        len(mapper._road_lookup) + len(mapper.roadlook_by_id))
+    return len(filenames), files_size(filenames), objects
+
+
+def phase_mapper():
+    mapper = pyets2.Ets2Mapper()
+    filenames = mapper.prefab_files + mapper.sector_files
+    return len(filenames), files_size(filenames), len(mapper.prefabs) + len(mapper.sectors)
+
+
+def phase_mapper_lazy_first_query():
+    mapper = pyets2.Ets2Mapper(lazy=True)
+    mapper.get_road_look('road.look0')
+    filenames = [
+        os.path.join(pyets2.DEF_SCS_DIR, 'def/world/road_look.sii'),
+        os.path.join(pyets2.ETS2MAP_LUT_DIR, 'LUT1.19-roads.csv'),
+    ]
+    return len(filenames), files_size(filenames), 1
+
+
+# List of (name, function, setup). Each function returns (files, bytes, objects).
+# If setup is not None, it is called once (without being measured), and its
+# result is passed to each call of the function.
+PHASES = [
+    ('sii_file_reader', phase_sii_file_reader, None),
+    ('Ets2Prefab.parse', phase_prefab_parse, None),
+    ('Ets2Mapper.loadLUT', phase_load_lut, setup_load_lut),
+    ('Ets2Mapper()', phase_mapper, None),
+    ('Ets2Mapper(lazy=True) first query', phase_mapper_lazy_first_query, None),
+]
+
+
+def run_phase(function, repeat, setup=None):
+    args = () if setup is None else (setup(),)
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        files, size, objects = function(*args)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best = min(times)
+    return {
+        'times': times,
+        'best': best,
+        'files': files,
+        'bytes': size,
+        'objects': objects,
+        'files_per_second': files / best if best else None,
+        'megabytes_per_second': size / 1024 / 1024 / best if best else None,
+        'objects_per_second': objects / best if best else None,
+        'peak_memory_bytes': peak,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(data_dir, options):
+    pyets2.BASE_SCS_DIR, pyets2.DEF_SCS_DIR, pyets2.ETS2MAP_LUT_DIR = generate_game_data(data_dir, options)
+
+    results = {
+        'commit': git_commit(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'parameters': {k: v for k, v in vars(options).items() if k not in ('json', 'data_dir')},
+        'phases': {},
+    }
+    for name, function, setup in PHASES:
+        r = results['phases'][name] = run_phase(function, options.repeat, setup)
+        print('{0:40s} {1:8.3f}s {2:10.1f} files/s {3:8.2f} MB/s {4:8.1f} MB peak'.format(
+            name, r['best'], r['files_per_second'] or 0, r['megabytes_per_second'] or 0, r['peak_memory_bytes'] / 1024 / 1024))
+    return results
+
+
+def main():
+    options = parse_args()
+
+    if options.data_dir is None:
+        with tempfile.TemporaryDirectory(prefix='pyets2_benchmark_') as data_dir:
+            results = run_benchmarks(data_dir, options)
+    else:
+        results = run_benchmarks(options.data_dir, options)
+
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
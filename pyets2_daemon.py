@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+#
+# Overview:
+#
+#   Long-running service that keeps a loaded pyets2.Ets2Mapper in memory and
+#   answers queries from other processes through a local (Unix) socket.
+#
+#   Usage:
+#
+#       pyets2_daemon.py serve [--lazy] [--socket /tmp/pyets2.sock]
+#       pyets2_daemon.py query '{"op": "road_look", "key": "road.look0"}' '{"op": "city", "key": 1}'
+#       pyets2_daemon.py query '{"op": "metrics"}'
+#
+#   The service polls BASE_SCS_DIR, DEF_SCS_DIR and ETS2MAP_LUT_DIR for
+#   changes. When a .ppd/.sii/.csv/.base file is added, modified or removed,
+#   only that file is parsed again (see Ets2Mapper.reload_files()), and the
+#   new Ets2Mapper replaces the old one in a single assignment. Queries
+#   already running keep using the old one until they finish.
+#
+#   If BASE_SCS_DIR or DEF_SCS_DIR point to .scs archives, the archives
+#   themselves are watched, and only the files that changed inside them are
+#   parsed again.
+#
+#   Each connection is handled by its own thread. With --lazy, the on-demand
+#   parsing inside the shared Ets2Mapper is serialized by its internal lock.
+#
+#
+# Protocol:
+#
+#   Each request is a single line of JSON, and each response is a single
+#   line of JSON. A request is either a single query or a batch:
+#
+#       {"op": "prefab", "key": "prefab.41"}
+#       {"queries": [{"op": "prefab", "key": 1234}, {"op": "road_look", "key": "road.look0"}]}
+#
+#   The response is {"result": ...} or {"error": "..."} for a single query,
+#   and {"results": [...]} for a batch (each item being one of those two).
+#   The whole batch is answered by the same Ets2Mapper, even if a reload
+#   happens in the meantime.
+#
+#   Available ops: prefab, road_look, company, city, sector, metrics.
+#
+#
+# Requirements:
+#   - Python 3.4
+#   - A Unix-like system (for Unix sockets)
+
+import argparse
+import json
+import os
+import os.path
+import socket
+import socketserver
+import threading
+import time
+
+import pyets2
+
+
+DEFAULT_SOCKET = '/tmp/pyets2.sock'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Keep ETS2 map data loaded and answer queries through a local socket.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--socket',
+        action='store',
+        default=DEFAULT_SOCKET,
+        type=str,
+        dest='socket',
+        help='Path of the Unix socket'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('serve', help='Run the service')
+    p.add_argument(
+        '--lazy',
+        action='store_true',
+        dest='lazy',
+        help='Parse the data on first access, instead of everything at startup'
+    )
+    p.add_argument(
+        '--interval',
+        action='store',
+        default=2.0,
+        type=float,
+        dest='interval',
+        help='Seconds between each check for changed files'
+    )
+
+    p = subparsers.add_parser('query', help='Send queries to a running service')
+    p.add_argument('queries', action='store', nargs='+', type=str, help='Each query as JSON')
+
+    return parser.parse_args()
+
+
+############################################################
+# Metrics.
+
+class LatencyMetric:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'last': self.last,
+        }
+
+
+############################################################
+# Converting pyets2 objects to JSON-friendly values.
+
+def curve_to_json(curve):
+    return {
+        'index': curve.index,
+        'start': curve.start,
+        'end': curve.end,
+        'length': curve.length,
+        'start_yaw': curve.start_yaw,
+        'end_yaw': curve.end_yaw,
+        'next': curve.next,
+        'prev': curve.prev,
+    }
+
+
+def node_to_json(node):
+    return {
+        'node': node.node,
+        'coord': node.coord,
+        'yaw': node.yaw,
+        'input_curve': [c.index for c in node.input_curve],
+        'output_curve': [c.index for c in node.output_curve],
+    }
+
+
+def prefab_to_json(prefab):
+    return {
+        'filename': prefab.filename,
+        'idx': prefab.idx,
+        'idsii': prefab.idsii,
+        'company': prefab.company.prefab_id if prefab.company else None,
+        'curves': [curve_to_json(c) for c in prefab.curves],
+        'nodes': [node_to_json(n) for n in prefab.nodes],
+    }
+
+
+def road_look_to_json(look):
+    return {a: getattr(look, a) for a in look._attrs}
+
+
+def company_to_json(company):
+    return {a: getattr(company, a) for a in 'prefab_id min_x min_y max_x max_y'.split()}
+
+
+def sector_to_json(sector):
+    return {'filename': sector.filename, 'version': sector.version}
+
+
+############################################################
+# The service.
+
+class MapService:
+    def __init__(self, lazy=False, interval=2.0):
+        self.interval = interval
+        self.reload_latency = LatencyMetric()
+        self.query_latency = {}  # Dict of str (op) : LatencyMetric
+        self._reload_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+
+        start = time.perf_counter()
+        self.mapper = pyets2.Ets2Mapper(lazy=lazy)
+        self.load_time = time.perf_counter() - start
+        self._snapshot = self.take_snapshot(self.mapper)
+
+        self.ops = {
+            'prefab': lambda mapper, key: prefab_to_json(mapper.get_prefab(key)),
+            'road_look': lambda mapper, key: road_look_to_json(mapper.get_road_look(key)),
+            'company': lambda mapper, key: company_to_json(self.get_company(mapper, key)),
+            'city': lambda mapper, key: mapper.get_city(key),
+            'sector': lambda mapper, key: sector_to_json(mapper.get_sector(key)),
+            'metrics': lambda mapper, key: self.metrics(),
+        }
+
+    @staticmethod
+    def get_company(mapper, key):
+        # Ets2Mapper.get_company() returns None for unknown ids, unlike the other getters.
+        company = mapper.get_company(key)
+        if company is None:
+            raise KeyError(key)
+        return company
+
+    @staticmethod
+    def take_snapshot(mapper):
+        '''Returns a dict of filename : (mtime, size) for all files used by the mapper.'''
+        snapshot = {}
+        for filename in mapper.watched_files():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            snapshot[filename] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def check_for_changes(self):
+        '''Reloads the changed files, if any. Returns the list of changed files.'''
+        with self._reload_lock:
+            snapshot = self.take_snapshot(self.mapper)
+            changed = [
+                filename
+                for filename in set(snapshot) | set(self._snapshot)
+                if snapshot.get(filename) != self._snapshot.get(filename)
+            ]
+            if changed:
+                start = time.perf_counter()
+                # A single assignment, so queries see either the old or the new mapper.
+                self.mapper = self.mapper.reload_files(changed)
+                self.reload_latency.add(time.perf_counter() - start)
+                print('Reloaded {0} files in {1:.3f}s'.format(len(changed), self.reload_latency.last))
+            self._snapshot = snapshot
+        return changed
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                # Files may be half-written during a game/mod update; try again later.
+                print('ERROR when reloading: {0!r}'.format(e))
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {
+                'load_time': self.load_time,
+                'reload': self.reload_latency.as_dict(),
+                'query': {op: m.as_dict() for op, m in self.query_latency.items()},
+            }
+
+    def run_query(self, mapper, query):
+        start = time.perf_counter()
+        op = query.get('op')
+        try:
+            if op not in self.ops:
+                raise KeyError('Unknown op {0!r}'.format(op))
+            response = {'result': self.ops[op](mapper, query.get('key'))}
+        except Exception as e:
+            response = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+        elapsed = time.perf_counter() - start
+        with self._metrics_lock:
+            self.query_latency.setdefault(str(op), LatencyMetric()).add(elapsed)
+        return response
+
+    def handle_request(self, request):
+        mapper = self.mapper
+        if 'queries' in request:
+            return {'results': [self.run_query(mapper, q) for q in request['queries']]}
+        return self.run_query(mapper, request)
+
+
+class ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError as e:
+                response = {'error': 'Invalid JSON: {0}'.format(e)}
+            else:
+                response = self.server.service.handle_request(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def serve(socket_path, lazy=False, interval=2.0):
+    service = MapService(lazy=lazy, interval=interval)
+    print('Loaded in {0:.3f}s'.format(service.load_time))
+
+    watcher = threading.Thread(target=service.watch, daemon=True)
+    watcher.start()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = ThreadingUnixStreamServer(socket_path, RequestHandler)
+    server.service = service
+    try:
+        print('Listening on {0}'.format(socket_path))
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+############################################################
+# Client.
+
+def query(socket_path, queries):
+    '''Sends a batch of queries (list of dicts) and returns the list of responses.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile('rwb') as f:
+            f.write(json.dumps({'queries': queries}).encode('utf-8') + b'\n')
+            f.flush()
+            return json.loads(f.readline().decode('utf-8'))['results']
+
+
+def main():
+    options = parse_args()
+
+    if options.command == 'serve':
+        serve(options.socket, options.lazy, options.interval)
+
+    elif options.command == 'query':
+        for response in query(options.socket, [json.loads(q) for q in options.queries]):
+            print(json.dumps(response, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+#
+# Overview:
+#
+#   Exports the data parsed by pyets2.Ets2Mapper into flat, normalized
+#   tables, so they can be explored without walking Python object graphs
+#   (and without parsing everything again in each session).
+#
+#   Usage:
+#
+#       pyets2_export.py --sqlite ets2map.sqlite --npz ets2map_npz/
+#
+#   And then, in a notebook:
+#
+#       tables = pyets2_export.load_npz('ets2map_npz/')
+#       curves = tables['prefab_curves']
+#       curves['length'][curves['prefab_id'] == 41]
+#
+#   Or, using SQLite:
+#
+#       SELECT p.idsii, count(*) FROM prefab_curves c JOIN prefabs p ON p.id = c.prefab_id GROUP BY p.id;
+#
+#
+# Format:
+#
+#   Each table in TABLES becomes a SQLite table (with its primary key and
+#   indexes) and a <table>.npz file with one array per column. Strings are
+#   stored as fixed-width unicode arrays. The .npz files are not compressed,
+#   so load_npz() can memory-map each column directly from the .npz file,
+#   and opening all tables takes only a few milliseconds.
+#
+#   The ids from the LUT*.csv files (prefabs.idx, cities.idx, roads.idx) are
+#   unsigned 64-bit integers: they are np.uint64 in the .npz files, but SQLite
+#   integers are signed, so there they are stored as their two's complement
+#   (i.e. ids >= 2**63 become negative). To convert them back:
+#
+#       SELECT printf('%x', idx) FROM cities;  -- Same hexadecimal as in the LUT.
+#       idx & 0xFFFFFFFFFFFFFFFF                # In Python.
+#
+#   Sector items are not exported yet, because pyets2.Ets2Sector does not
+#   parse them yet; only the list of sectors is.
+#
+#
+# Requirements:
+#   - Python 3.4
+#   - numpy
+
+import argparse
+import os
+import os.path
+import sqlite3
+import struct
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+import pyets2
+
+
+# Dict of table name : (list of (column, type), primary key, list of indexed columns)
+# The types are the SQL ones, plus UINT64 (see SQL_TYPES).
+TABLES = OrderedDict([
+    ('prefabs', ([
+        ('id', 'INTEGER'),
+        ('idx', 'UINT64'),
+        ('idsii', 'TEXT'),
+        ('filename', 'TEXT'),
+    ], 'id', ['idx', 'idsii'])),
+    ('prefab_curves', ([
+        ('prefab_id', 'INTEGER'),
+        ('curve', 'INTEGER'),
+        ('start_x', 'REAL'),
+        ('start_y', 'REAL'),
+        ('start_z', 'REAL'),
+        ('end_x', 'REAL'),
+        ('end_y', 'REAL'),
+        ('end_z', 'REAL'),
+        ('length', 'REAL'),
+        ('start_yaw', 'REAL'),
+        ('end_yaw', 'REAL'),
+    ], 'prefab_id, curve', [])),
+    ('prefab_curve_links', ([
+        ('prefab_id', 'INTEGER'),
+        ('curve', 'INTEGER'),
+        ('next_curve', 'INTEGER'),
+    ], 'prefab_id, curve, next_curve', [])),
+    ('prefab_nodes', ([
+        ('prefab_id', 'INTEGER'),
+        ('node', 'INTEGER'),
+        ('x', 'REAL'),
+        ('y', 'REAL'),
+        ('z', 'REAL'),
+        ('rotation_x', 'REAL'),
+        ('rotation_y', 'REAL'),
+        ('rotation_z', 'REAL'),
+        ('yaw', 'REAL'),
+    ], 'prefab_id, node', [])),
+    ('prefab_node_curves', ([
+        ('prefab_id', 'INTEGER'),
+        ('node', 'INTEGER'),
+        ('is_output', 'BOOLEAN'),
+        ('curve', 'INTEGER'),
+    ], 'prefab_id, node, is_output, curve', [])),
+    ('companies', ([
+        ('id', 'INTEGER'),
+        ('prefab_idsii', 'TEXT'),
+        ('prefab_id', 'INTEGER'),
+        ('min_x', 'INTEGER'),
+        ('min_y', 'INTEGER'),
+        ('max_x', 'INTEGER'),
+        ('max_y', 'INTEGER'),
+    ], 'id', ['prefab_idsii', 'prefab_id'])),
+    ('cities', ([
+        ('idx', 'UINT64'),
+        ('name', 'TEXT'),
+    ], 'idx', ['name'])),
+    ('road_looks', ([
+        ('id', 'INTEGER'),
+        ('look_id', 'TEXT'),
+        ('is_highway', 'BOOLEAN'),
+        ('is_local', 'BOOLEAN'),
+        ('is_express', 'BOOLEAN'),
+        ('offset', 'REAL'),
+        ('size_left', 'REAL'),
+        ('size_right', 'REAL'),
+        ('shoulder_left', 'REAL'),
+        ('shoulder_right', 'REAL'),
+        ('lanes_left', 'INTEGER'),
+        ('lanes_right', 'INTEGER'),
+    ], 'id', ['look_id'])),
+    ('roads', ([
+        ('idx', 'UINT64'),
+        ('road_look_id', 'INTEGER'),
+    ], 'idx', ['road_look_id'])),
+    ('sectors', ([
+        ('id', 'INTEGER'),
+        ('filename', 'TEXT'),
+        ('version', 'INTEGER'),
+    ], 'id', [])),
+])
+
+SQL_TYPES = {
+    'UINT64': 'INTEGER',  # Stored as the two's complement, see uint64_to_sqlite().
+}
+
+NUMPY_TYPES = {
+    'UINT64': np.uint64,
+    'INTEGER': np.int64,
+    'REAL': np.float64,
+    'BOOLEAN': np.bool_,
+    'TEXT': np.str_,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Export ETS2 map data to SQLite and/or NumPy .npz files.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--sqlite',
+        action='store',
+        default=None,
+        type=str,
+        dest='sqlite',
+        help='SQLite database to be (re)created'
+    )
+    parser.add_argument(
+        '--npz',
+        action='store',
+        default=None,
+        type=str,
+        dest='npz',
+        help='Directory where the .npz files will be written'
+    )
+    options = parser.parse_args()
+
+    if options.sqlite is None and options.npz is None:
+        parser.error('Nothing to do, use --sqlite and/or --npz')
+
+    return options
+
+
+############################################################
+# Flattening the Ets2Mapper objects.
+
+def build_rows(mapper):
+    '''Returns a dict of table name : list of row tuples (in the same order as TABLES).'''
+    rows = {name: [] for name in TABLES}
+
+    prefab_ids = {}  # Dict of str (idsii) : int (prefab id)
+    for prefab_id, prefab in enumerate(mapper.iter_prefabs()):
+        if prefab.idsii:
+            prefab_ids[prefab.idsii] = prefab_id
+        rows['prefabs'].append((prefab_id, prefab.idx, prefab.idsii, prefab.filename))
+        for c in prefab.curves:
+            rows['prefab_curves'].append((
+                prefab_id, c.index,
+                c.start.x, c.start.y, c.start.z,
+                c.end.x, c.end.y, c.end.z,
+                c.length, c.start_yaw, c.end_yaw,
+            ))
+            rows['prefab_curve_links'].extend((prefab_id, c.index, i) for i in sorted(set(c.next)))
+        for n in prefab.nodes:
+            rows['prefab_nodes'].append((
+                prefab_id, n.node,
+                n.coord.x, n.coord.y, n.coord.z,
+                n.rotation.x, n.rotation.y, n.rotation.z,
+                n.yaw,
+            ))
+            links = set((False, c.index) for c in n.input_curve) | set((True, c.index) for c in n.output_curve)
+            rows['prefab_node_curves'].extend((prefab_id, n.node, is_output, i) for is_output, i in sorted(links))
+
+    for company_id, company in enumerate(mapper.iter_companies()):
+        rows['companies'].append((
+            company_id, company.prefab_id, prefab_ids.get(company.prefab_id, -1),
+            company.min_x, company.min_y, company.max_x, company.max_y,
+        ))
+
+    rows['cities'] = sorted(mapper.iter_cities())
+
+    look_ids = {}  # Dict of str (look_id) : int (road look id)
+    for look_id, look in enumerate(mapper.iter_road_looks()):
+        look_ids[look.look_id] = look_id
+        rows['road_looks'].append((look_id,) + tuple(getattr(look, a) for a in pyets2.Ets2RoadLook._attrs))
+
+    rows['roads'] = sorted((idx, look_ids[look.look_id]) for idx, look in mapper.iter_roads())
+
+    for sector_id, sector in enumerate(mapper.iter_sectors()):
+        rows['sectors'].append((sector_id, sector.filename, sector.version))
+
+    return rows
+
+
+def rows_to_columns(name, rows):
+    '''Converts a list of row tuples into an OrderedDict of column name : numpy array.'''
+    columns, primary_key, indexes = TABLES[name]
+    values = list(zip(*rows)) if rows else [() for c in columns]
+    return OrderedDict(
+        (column, np.array(v, dtype=NUMPY_TYPES[sql_type]))
+        for (column, sql_type), v in zip(columns, values)
+    )
+
+
+############################################################
+# Writing.
+
+def uint64_to_sqlite(value):
+    '''SQLite integers are signed 64-bit, so uint64 values are stored as their two's complement.'''
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def write_sqlite(filename, rows):
+    if os.path.exists(filename):
+        os.unlink(filename)
+    with sqlite3.connect(filename) as db:
+        for name, (columns, primary_key, indexes) in TABLES.items():
+            db.execute('CREATE TABLE {0} ({1}, PRIMARY KEY ({2}))'.format(
+                name,
+                ', '.join('"{0}" {1}'.format(c, SQL_TYPES.get(t, t)) for c, t in columns),
+                primary_key,
+            ))
+            table_rows = rows[name]
+            uint64_columns = [i for i, (c, t) in enumerate(columns) if t == 'UINT64']
+            if uint64_columns:
+                table_rows = (
+                    tuple(uint64_to_sqlite(v) if i in uint64_columns else v for i, v in enumerate(row))
+                    for row in table_rows
+                )
+            db.executemany(
+                'INSERT INTO {0} VALUES ({1})'.format(name, ', '.join('?' * len(columns))),
+                table_rows)
+            for column in indexes:
+                db.execute('CREATE INDEX {0}_{1} ON {0} ("{1}")'.format(name, column))
+    db.close()
+
+
+def write_npz(directory, rows):
+    os.makedirs(directory, exist_ok=True)
+    for name in TABLES:
+        # np.savez (not savez_compressed), so the columns can be memory-mapped.
+        np.savez(os.path.join(directory, name + '.npz'), **rows_to_columns(name, rows[name]))
+
+
+############################################################
+# Loading.
+
+def _mmap_npz(filename):
+    '''Returns an OrderedDict of name : read-only np.memmap for each array in an uncompressed .npz file.'''
+    arrays = OrderedDict()
+    with zipfile.ZipFile(filename) as z, open(filename, 'rb') as f:
+        for info in z.infolist():
+            name = os.path.splitext(info.filename)[0]
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Array "{0}" in "{1}" is compressed and cannot be memory-mapped'.format(name, filename))
+
+            # The local file header has a variable-length name and extra field.
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if dtype.hasobject:
+                raise ValueError('Array "{0}" in "{1}" has Python objects'.format(name, filename))
+            if 0 in shape:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    filename, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                    order='F' if fortran_order else 'C')
+    return arrays
+
+
+def load_npz(directory):
+    '''Returns a dict of table name : OrderedDict of column name : memory-mapped numpy array.'''
+    return {
+        name: _mmap_npz(os.path.join(directory, name + '.npz'))
+        for name in TABLES
+    }
+
+
+def main():
+    options = parse_args()
+
+    mapper = pyets2.Ets2Mapper(lazy=True)
+    rows = build_rows(mapper)
+    for name in TABLES:
+        print('{0}: {1} rows'.format(name, len(rows[name])))
+
+    if options.sqlite is not None:
+        write_sqlite(options.sqlite, rows)
+    if options.npz is not None:
+        write_npz(options.npz, rows)
+
+    print('Finished!')
+
+if __name__ == '__main__':
+    main()
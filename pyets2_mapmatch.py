@@ -0,0 +1,367 @@
+# Overview:
+#
+#   Snaps truck positions (from the telemetry) to the road network, for use
+#   in live route advice.
+#
+#   Sample code:
+#
+#       network = pyets2_mapmatch.RoadNetwork.from_prefabs([
+#           (mapper.get_prefab('prefab.41'), 1000.0, -2000.0, 0.0),  # (prefab, x, z, rotation)
+#           ...
+#       ])
+#       matcher = pyets2_mapmatch.MapMatcher(network)
+#       result = matcher.match(x, z, heading, truck)  # Arrays, one item per sample.
+#       result.curve  # Index of the matched curve in network, or -1.
+#
+#   Each curve is approximated by the straight segment between its start and
+#   end points, with the yaw interpolated between start_yaw and end_yaw.
+#   Headings use the same convention as Ets2PrefabCurve.start_yaw, i.e.
+#   atan2(dz, dx) of the direction of travel.
+#
+#
+# How it works:
+#
+#   1. The segments are stored in a uniform grid. Each segment is added to
+#      every cell within search_radius of its bounding box, so the candidates
+#      for a sample are exactly the segments listed in its own cell.
+#   2. For the whole batch at once, the distance from each sample to each of
+#      its candidates, and the difference between the sample heading and the
+#      curve yaw, are computed as (samples x candidates) numpy arrays. These
+#      are the emission costs.
+#   3. The samples of each truck are matched in sequence, using the Viterbi
+#      algorithm (as in HMM map-matching): staying on the same curve costs
+#      nothing, moving to a connected curve (next/prev) costs a little, and
+#      jumping to an unrelated curve costs a lot. Each step is vectorized
+#      across all trucks. Long runs of samples of the same truck are split
+#      into windows of window samples (plus window_overlap samples on each
+#      side), which are matched as if they were different trucks. The last
+#      match of each truck is remembered for the next batch.
+#
+#
+# Requirements:
+#   - Python 3.4
+#   - numpy
+
+import math
+from collections import namedtuple
+
+import numpy as np
+
+
+MatchResult = namedtuple('MatchResult', 'curve distance t x z')
+# Types (all numpy arrays, one item per sample, in the same order as the input):
+# curve: int (index in RoadNetwork, or -1 if nothing was found within search_radius)
+# distance: float (distance to the matched curve)
+# t: float (0.0 at the start of the curve, 1.0 at the end)
+# x, z: float (the matched position, on the curve)
+
+
+def wrap_angle(a):
+    '''Wraps angles (in radians) to the [-pi, pi) interval.'''
+    return (a + np.pi) % (2 * np.pi) - np.pi
+
+
+class RoadNetwork:
+    '''Set of curves (as straight segments), with their connections and a grid for spatial lookups.'''
+
+    def __init__(self, start_x, start_z, end_x, end_z, start_yaw, end_yaw, connections=(), cell_size=50.0, search_radius=20.0):
+        self.start_x = np.asarray(start_x, dtype=np.float64)
+        self.start_z = np.asarray(start_z, dtype=np.float64)
+        self.end_x = np.asarray(end_x, dtype=np.float64)
+        self.end_z = np.asarray(end_z, dtype=np.float64)
+        self.start_yaw = np.asarray(start_yaw, dtype=np.float64)
+        self.delta_yaw = wrap_angle(np.asarray(end_yaw, dtype=np.float64) - self.start_yaw)
+        self.dx = self.end_x - self.start_x
+        self.dz = self.end_z - self.start_z
+        length2 = self.dx * self.dx + self.dz * self.dz
+        self.inv_length2 = np.where(length2 > 0, 1.0 / np.where(length2 > 0, length2, 1.0), 0.0)
+
+        self.cell_size = float(cell_size)
+        self.search_radius = float(search_radius)
+
+        # Connections (in both directions) as sorted int64 keys: a * len(self) + b.
+        n = len(self)
+        pairs = np.asarray(list(connections), dtype=np.int64).reshape(-1, 2)
+        keys = np.concatenate([pairs[:, 0] * n + pairs[:, 1], pairs[:, 1] * n + pairs[:, 0]])
+        self._connection_keys = np.unique(keys)
+
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.start_x)
+
+    def __repr__(self):
+        return '<RoadNetwork curves={0} cells={1} at {2}>'.format(len(self), len(self._cell_keys), hex(id(self)))
+
+    @classmethod
+    def from_prefabs(cls, placements, **kwargs):
+        '''Builds the network from an iterable of (Ets2Prefab, x, z, rotation).
+
+        The prefab curves are rotated by rotation (radians, counterclockwise
+        in the x/z plane) and then moved to (x, z). Connections are taken from
+        Ets2PrefabCurve.next.
+        '''
+        columns = ([], [], [], [], [], [])
+        connections = []
+        for prefab, x, z, rotation in placements:
+            cos = math.cos(rotation)
+            sin = math.sin(rotation)
+            base = len(columns[0])
+            for curve in prefab.curves:
+                columns[0].append(x + curve.start.x * cos - curve.start.z * sin)
+                columns[1].append(z + curve.start.x * sin + curve.start.z * cos)
+                columns[2].append(x + curve.end.x * cos - curve.end.z * sin)
+                columns[3].append(z + curve.end.x * sin + curve.end.z * cos)
+                columns[4].append(curve.start_yaw + rotation)
+                columns[5].append(curve.end_yaw + rotation)
+                connections.extend((base + curve.index, base + i) for i in curve.next)
+        return cls(*columns, connections=connections, **kwargs)
+
+    def _cell_key(self, cx, cz):
+        # Cells are packed into a single int64; 2**31 cells per axis is plenty.
+        return (cx.astype(np.int64) + 2**31) * 2**32 + (cz.astype(np.int64) + 2**31)
+
+    def _build_grid(self):
+        r = self.search_radius
+        cx0 = np.floor((np.minimum(self.start_x, self.end_x) - r) / self.cell_size).astype(np.int64)
+        cx1 = np.floor((np.maximum(self.start_x, self.end_x) + r) / self.cell_size).astype(np.int64)
+        cz0 = np.floor((np.minimum(self.start_z, self.end_z) - r) / self.cell_size).astype(np.int64)
+        cz1 = np.floor((np.maximum(self.start_z, self.end_z) + r) / self.cell_size).astype(np.int64)
+
+        # Enumerating all (segment, cell) pairs without a Python loop.
+        width = cx1 - cx0 + 1
+        counts = width * (cz1 - cz0 + 1)
+        segment = np.repeat(np.arange(len(self), dtype=np.int64), counts)
+        local = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = self._cell_key(cx0[segment] + local % width[segment], cz0[segment] + local // width[segment])
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        segment = segment[order]
+        self._cell_keys, first, per_cell = np.unique(keys, return_index=True, return_counts=True)
+
+        # Padded table: one row per cell, -1 for unused slots.
+        max_per_cell = int(per_cell.max()) if len(per_cell) else 1
+        self._cell_table = np.full((len(self._cell_keys), max_per_cell), -1, dtype=np.int64)
+        slot = np.arange(len(keys)) - np.repeat(first, per_cell)
+        self._cell_table[np.repeat(np.arange(len(self._cell_keys)), per_cell), slot] = segment
+
+    def candidates(self, x, z):
+        '''Returns a (samples x max_per_cell) array of curve indexes, -1 for empty slots.'''
+        keys = self._cell_key(np.floor(x / self.cell_size), np.floor(z / self.cell_size))
+        if len(self._cell_keys) == 0:
+            return np.full((len(keys), 1), -1, dtype=np.int64)
+        row = np.searchsorted(self._cell_keys, keys)
+        row = np.minimum(row, len(self._cell_keys) - 1)
+        found = self._cell_keys[row] == keys
+        result = self._cell_table[row]
+        result[~found] = -1
+        return result
+
+    def are_connected(self, a, b):
+        '''Element-wise check if curves a and b are connected (arrays of the same shape, -1 allowed).'''
+        keys = a * len(self) + b
+        if len(self._connection_keys) == 0:
+            return np.zeros(keys.shape, dtype=bool)
+        pos = np.searchsorted(self._connection_keys, keys)
+        pos = np.minimum(pos, len(self._connection_keys) - 1)
+        return (self._connection_keys[pos] == keys) & (a >= 0) & (b >= 0)
+
+
+class MapMatcher:
+    '''Matches batches of (x, z, heading) samples from many trucks to a RoadNetwork.
+
+    Runs of more than window samples of the same truck are matched in windows
+    (see match()); a larger window_overlap gives results closer to matching
+    the whole run at once, but is slower.
+    '''
+
+    def __init__(self, network, sigma_distance=5.0, heading_weight=4.0, connected_cost=1.0, jump_cost=8.0, max_candidates=4,
+                 window=64, window_overlap=16):
+        self.network = network
+        self.max_candidates = max_candidates
+        self.window = window
+        self.window_overlap = window_overlap
+        self.sigma_distance = sigma_distance
+        self.heading_weight = heading_weight
+        self.connected_cost = connected_cost
+        self.jump_cost = jump_cost
+        self._previous = {}  # Dict of truck id : int (last matched curve)
+
+    def reset(self, truck=None):
+        '''Forgets the previous match of a truck (or of all trucks).'''
+        if truck is None:
+            self._previous.clear()
+        else:
+            self._previous.pop(truck, None)
+
+    def _transition_cost(self, a, b):
+        cost = np.where(a == b, 0.0, np.where(self.network.are_connected(a, b), self.connected_cost, self.jump_cost))
+        # Unknown previous match: no preference.
+        return np.where(a < 0, 0.0, cost)
+
+    def _viterbi(self, cand, emission, is_first, previous):
+        '''Matches independent chains of samples; returns the chosen candidate (column) of each sample.
+
+        The samples of each chain are contiguous and in order; is_first marks
+        the first sample of each chain, and previous has the curve matched
+        before each chain (or -1).
+        '''
+        n = len(cand)
+        index = np.arange(n)
+        is_last = np.ones(n, dtype=bool)
+        is_last[:-1] = is_first[1:]
+        # rank = position of the sample within its chain.
+        rank = index - np.maximum.accumulate(np.where(is_first, index, 0))
+
+        by_rank = np.argsort(rank, kind='stable')
+        bounds = np.searchsorted(rank[by_rank], np.arange(rank.max() + 2))
+
+        # Forward pass.
+        acc = np.empty_like(emission)
+        back = np.zeros(cand.shape, dtype=np.int64)
+        restart = np.zeros(n, dtype=bool)
+
+        first = by_rank[bounds[0]:bounds[1]]
+        acc[first] = emission[first] + self._transition_cost(previous[:, None], cand[first])
+
+        for r in range(1, len(bounds) - 1):
+            s = by_rank[bounds[r]:bounds[r + 1]]
+            p = s - 1
+            total = acc[p][:, :, None] + self._transition_cost(cand[p][:, :, None], cand[s][:, None, :])
+            back[s] = np.argmin(total, axis=1)
+            acc[s] = np.min(total, axis=1) + emission[s]
+            # If the previous sample matched nothing, start a new chain here.
+            broken = np.all(np.isinf(acc[p]), axis=1)
+            restart[s[broken]] = True
+            acc[s[broken]] = emission[s[broken]]
+
+        # Backward pass.
+        chosen = np.zeros(n, dtype=np.int64)
+        chosen[is_last] = np.argmin(acc[is_last], axis=1)
+        for r in range(len(bounds) - 2, 0, -1):
+            s = by_rank[bounds[r]:bounds[r + 1]]
+            chosen[s - 1] = np.where(
+                restart[s],
+                np.argmin(acc[s - 1], axis=1),
+                back[s, chosen[s]])
+        return chosen
+
+    def _emission_cost(self, x, z, heading, cand):
+        net = self.network
+        valid = cand >= 0
+        c = np.where(valid, cand, 0)
+
+        sx = net.start_x[c]
+        sz = net.start_z[c]
+        dx = net.dx[c]
+        dz = net.dz[c]
+        px = x[:, None] - sx
+        pz = z[:, None] - sz
+        t = np.clip((px * dx + pz * dz) * net.inv_length2[c], 0.0, 1.0)
+        ex = px - t * dx
+        ez = pz - t * dz
+        distance = np.sqrt(ex * ex + ez * ez)
+
+        yaw = net.start_yaw[c] + t * net.delta_yaw[c]
+        heading_cost = 1.0 - np.cos(heading[:, None] - yaw)
+
+        cost = (distance / self.sigma_distance) ** 2 + self.heading_weight * heading_cost
+        cost[~valid | (distance > net.search_radius)] = np.inf
+        return cost, distance, t
+
+    def match(self, x, z, heading, truck=None):
+        '''Matches a batch of samples; returns a MatchResult.
+
+        x, z, heading and truck are array-likes with one item per sample.
+        The samples of each truck must be in chronological order, but samples
+        of different trucks may be interleaved. If truck is None, all samples
+        belong to the same truck. The samples of each truck are matched in
+        windows of window samples, each one with window_overlap extra samples
+        on both sides.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        heading = np.asarray(heading, dtype=np.float64)
+        n = len(x)
+        if truck is None:
+            truck = np.zeros(n, dtype=np.int64)
+        else:
+            truck = np.asarray(truck)
+        if n == 0:
+            empty = np.zeros(0)
+            return MatchResult(np.zeros(0, dtype=np.int64), empty, empty, empty, empty)
+        if len(self.network) == 0:
+            # No curves at all, so nothing can be matched.
+            for k in np.unique(truck).tolist():
+                self._previous.pop(k, None)
+            nan = np.full(n, np.nan)
+            return MatchResult(np.full(n, -1, dtype=np.int64), nan, nan.copy(), nan.copy(), nan.copy())
+
+        # Grouping the samples by truck, keeping their order.
+        order = np.argsort(truck, kind='stable')
+        x = x[order]
+        z = z[order]
+        heading = heading[order]
+        truck = truck[order]
+
+        cand = self.network.candidates(x, z)
+        emission, distance, t = self._emission_cost(x, z, heading, cand)
+
+        # Keeping only the best candidates, so the Viterbi steps stay small.
+        if cand.shape[1] > self.max_candidates:
+            best = np.argpartition(emission, self.max_candidates - 1, axis=1)[:, :self.max_candidates]
+            cand = np.take_along_axis(cand, best, axis=1)
+            emission = np.take_along_axis(emission, best, axis=1)
+            distance = np.take_along_axis(distance, best, axis=1)
+            t = np.take_along_axis(t, best, axis=1)
+
+        # Splitting the samples of each truck into windows of (at most) window
+        # samples. Each window is matched as a chain that also includes (up
+        # to) window_overlap samples before and after it, whose matches are
+        # discarded: they are only there so the path inside the window is
+        # (nearly) the same as if the whole run was matched at once. Each
+        # Viterbi step handles one sample of every chain, so a long run of a
+        # single truck is as fast as many short ones.
+        index = np.arange(n)
+        is_first = np.ones(n, dtype=bool)
+        is_first[1:] = truck[1:] != truck[:-1]
+        is_last = np.ones(n, dtype=bool)
+        is_last[:-1] = is_first[1:]
+        truck_start = np.maximum.accumulate(np.where(is_first, index, 0))
+        truck_end = np.minimum.accumulate(np.where(is_last, index + 1, n)[::-1])[::-1]
+        starts = np.flatnonzero((index - truck_start) % self.window == 0)
+        ends = np.append(starts[1:], n)
+        begins = np.maximum(truck_start[starts], starts - self.window_overlap)
+        lengths = np.minimum(truck_end[starts], ends + self.window_overlap) - begins
+        chain_start = np.cumsum(lengths) - lengths
+        src = np.repeat(begins - chain_start, lengths) + np.arange(lengths.sum())
+        keep = (src >= np.repeat(starts, lengths)) & (src < np.repeat(ends, lengths))
+        chain_first = np.zeros(len(src), dtype=bool)
+        chain_first[chain_start] = True
+
+        # Only the chains starting at the first sample of a truck know its previous match.
+        previous = np.array([self._previous.get(k, -1) for k in truck[begins].tolist()], dtype=np.int64)
+        previous[~is_first[begins]] = -1
+
+        chosen = np.zeros(n, dtype=np.int64)
+        chosen[src[keep]] = self._viterbi(cand[src], emission[src], chain_first, previous)[keep]
+
+        matched = np.isfinite(emission[index, chosen])
+        curve = np.where(matched, cand[index, chosen], -1)
+        dist = np.where(matched, distance[index, chosen], np.nan)
+        tt = np.where(matched, t[index, chosen], np.nan)
+        c = np.where(matched, curve, 0)
+        mx = np.where(matched, self.network.start_x[c] + tt * self.network.dx[c], np.nan)
+        mz = np.where(matched, self.network.start_z[c] + tt * self.network.dz[c], np.nan)
+
+        for k, value in zip(truck[is_last].tolist(), curve[is_last].tolist()):
+            if value >= 0:
+                self._previous[k] = value
+            else:
+                self._previous.pop(k, None)
+
+        # Back to the original order of the samples.
+        inverse = np.empty(n, dtype=np.int64)
+        inverse[order] = index
+        return MatchResult(curve[inverse], dist[inverse], tt[inverse], mx[inverse], mz[inverse])
@@ -0,0 +1,167 @@
+# Overview:
+#
+#   Builds the outlines (edges and shoulders) of many roads at once, for
+#   rendering, map-matching tolerances or collision with prefabs.
+#
+#   Sample code:
+#
+#       table = pyets2_roads.RoadProfileTable.from_mapper(mapper)
+#       geometry = pyets2_roads.build_road_geometry(
+#           table, table.indexes(look_ids),
+#           start_x, start_z, end_x, end_z, start_yaw, end_yaw,
+#           points=16)
+#       geometry.left_edge  # Array of shape (roads, points, 2), with (x, z) coordinates.
+#
+#   Each road is a Hermite curve from (start_x, start_z) to (end_x, end_z),
+#   leaving at start_yaw and arriving at end_yaw (same convention as
+#   Ets2PrefabCurve.start_yaw, i.e. atan2(dz, dx)). All roads are sampled at
+#   the same number of points, in a single vectorized pass.
+#
+#   "Right" is the right-hand side when driving from start to end, i.e. the
+#   (-dz, dx) direction, because the z axis points south.
+#
+#
+# Road profile:
+#
+#   The lateral distances from the centerline depend only on the
+#   Ets2RoadLook, so they are computed once per look_id and shared by all
+#   roads using that look (RoadProfileTable is a flyweight table):
+#
+#       edge = offset / 2 + size  (or lanes * LANE_WIDTH, if size is zero)
+#       shoulder = edge + shoulder_size
+#
+#   Distances to the left are negative.
+#
+#
+# Requirements:
+#   - Python 3.4
+#   - numpy
+
+from collections import namedtuple
+
+import numpy as np
+
+import pyets2
+
+
+RoadProfile = namedtuple('RoadProfile', 'left_shoulder left_edge right_edge right_shoulder')
+# Types:
+# left_shoulder, left_edge, right_edge, right_shoulder: float (signed distance from the centerline)
+
+RoadGeometry = namedtuple('RoadGeometry', 'center left_edge right_edge left_shoulder right_shoulder')
+# Types (all numpy arrays of shape (roads, points, 2), with (x, z) coordinates):
+# center, left_edge, right_edge, left_shoulder, right_shoulder
+
+
+def road_profile(look):
+    '''Computes the RoadProfile of an Ets2RoadLook.'''
+    size_left = look.size_left or pyets2.LANE_WIDTH * look.lanes_left
+    size_right = look.size_right or pyets2.LANE_WIDTH * look.lanes_right
+    half_offset = (look.offset or 0.0) / 2
+    left_edge = -(half_offset + size_left)
+    right_edge = half_offset + size_right
+    return RoadProfile(
+        left_shoulder = left_edge - (look.shoulder_left or 0.0),
+        left_edge = left_edge,
+        right_edge = right_edge,
+        right_shoulder = right_edge + (look.shoulder_right or 0.0),
+    )
+
+
+class RoadProfileTable:
+    '''Flyweight table of RoadProfile, one row per look_id.'''
+
+    def __init__(self, looks=()):
+        self._index = {}  # Dict of str (look_id) : int (row)
+        self._profiles = []  # List of RoadProfile
+        self._array = None
+        for look in looks:
+            self.add(look)
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def __repr__(self):
+        return '<RoadProfileTable looks={0} at {1}>'.format(len(self), hex(id(self)))
+
+    @classmethod
+    def from_mapper(cls, mapper):
+        return cls(mapper.iter_road_looks())
+
+    def add(self, look):
+        '''Adds an Ets2RoadLook (if not already there) and returns its row.'''
+        row = self._index.get(look.look_id)
+        if row is None:
+            row = self._index[look.look_id] = len(self._profiles)
+            self._profiles.append(road_profile(look))
+            self._array = None
+        return row
+
+    def __getitem__(self, look_id):
+        return self._profiles[self._index[look_id]]
+
+    def indexes(self, looks):
+        '''Converts a sequence of look_id (or Ets2RoadLook) into an array of rows.'''
+        return np.fromiter(
+            (self._index[x] if isinstance(x, str) else self.add(x) for x in looks),
+            dtype=np.intp)
+
+    @property
+    def array(self):
+        '''All profiles as a (looks, 4) array, in the same order as RoadProfile fields.'''
+        if self._array is None:
+            self._array = np.array(self._profiles, dtype=np.float64).reshape(-1, len(RoadProfile._fields))
+        return self._array
+
+
+def build_road_geometry(table, look_indexes, start_x, start_z, end_x, end_z, start_yaw, end_yaw, points=8):
+    '''Builds the center, edge and shoulder polylines of many roads; returns a RoadGeometry.
+
+    look_indexes are rows of table (see RoadProfileTable.indexes()); all
+    other arguments are array-likes with one item per road.
+    '''
+    p0 = np.stack([np.asarray(start_x, dtype=np.float64), np.asarray(start_z, dtype=np.float64)], axis=-1)
+    p1 = np.stack([np.asarray(end_x, dtype=np.float64), np.asarray(end_z, dtype=np.float64)], axis=-1)
+    start_yaw = np.asarray(start_yaw, dtype=np.float64)
+    end_yaw = np.asarray(end_yaw, dtype=np.float64)
+
+    # Tangents, scaled by the distance between both ends.
+    length = np.linalg.norm(p1 - p0, axis=-1)[:, None]
+    m0 = np.stack([np.cos(start_yaw), np.sin(start_yaw)], axis=-1) * length
+    m1 = np.stack([np.cos(end_yaw), np.sin(end_yaw)], axis=-1) * length
+
+    # Hermite basis functions (and their derivatives), shape (points, 1).
+    t = np.linspace(0.0, 1.0, points)[:, None]
+    t2 = t * t
+    t3 = t2 * t
+    h00 = 2 * t3 - 3 * t2 + 1
+    h10 = t3 - 2 * t2 + t
+    h01 = -2 * t3 + 3 * t2
+    h11 = t3 - t2
+    d00 = 6 * t2 - 6 * t
+    d10 = 3 * t2 - 4 * t + 1
+    d01 = -6 * t2 + 6 * t
+    d11 = 3 * t2 - 2 * t
+
+    # Shape (roads, points, 2).
+    p0 = p0[:, None, :]
+    p1 = p1[:, None, :]
+    m0 = m0[:, None, :]
+    m1 = m1[:, None, :]
+    center = h00 * p0 + h10 * m0 + h01 * p1 + h11 * m1
+    tangent = d00 * p0 + d10 * m0 + d01 * p1 + d11 * m1
+
+    norm = np.linalg.norm(tangent, axis=-1, keepdims=True)
+    norm[norm == 0] = 1.0
+    tangent /= norm
+    right = np.stack([-tangent[..., 1], tangent[..., 0]], axis=-1)
+
+    profiles = table.array[np.asarray(look_indexes, dtype=np.intp)]  # Shape (roads, 4).
+    offsets = lambda column: profiles[:, column][:, None, None]
+    return RoadGeometry(
+        center = center,
+        left_edge = center + right * offsets(1),
+        right_edge = center + right * offsets(2),
+        left_shoulder = center + right * offsets(0),
+        right_shoulder = center + right * offsets(3),
+    )
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+#
+# Overview:
+#
+#   Builds a manifest of a tile tree (such as funbit-map-medium-dark-final/ or
+#   koenvh1-promods-rusmap/) and uses it to copy only what has changed to
+#   another copy of the tree (e.g. the one served by the web server).
+#
+#   Usage:
+#
+#       sync_tiles.py manifest funbit-map-medium-dark-final/
+#       sync_tiles.py diff old.tiles-manifest.gz new.tiles-manifest.gz
+#       sync_tiles.py sync funbit-map-medium-dark-final/ /srv/www/funbit-map-medium-dark-final/
+#       sync_tiles.py sync -o ~/www-tiles-manifest.gz funbit-map-medium-dark-final/ /srv/www/funbit-map-medium-dark-final/
+#
+#
+# Motivation:
+#
+#   Shipping a new version of the tiles used to mean copying all the ~18500
+#   files, even if only a handful of them had changed. Besides, most tiles are
+#   identical (around 81% of them, see optimize_png_tiles.py), so even the
+#   files that did change are mostly copies of each other.
+#
+#   This script:
+#
+#   1. Finds all files in the tile directory, and stores their path, size,
+#      modification time and content hash in a manifest. The manifest is a
+#      gzipped text file, sorted by path, saved inside the tile directory
+#      itself (or wherever -o says). Files whose size and mtime match the
+#      previous manifest are not hashed again. The remaining files are hashed
+#      in parallel.
+#   2. Compares two manifests by walking both sorted lists at the same time.
+#   3. Applies the difference to the destination: each new/changed unique
+#      blob is copied only once, and all other files with the same contents
+#      are recreated as hard links to it (falling back to a plain copy if the
+#      filesystem does not support hard links). Files that no longer exist in
+#      the source are removed from the destination.
+#
+#   Note that, by default, the manifest of the destination is written inside
+#   it, so a web server serving that directory also publishes the manifest
+#   (the list of all tiles, with their sizes, mtimes and hashes). Use
+#   "sync -o" to keep it somewhere else.
+#
+#
+# Requirements:
+#   - Python 3.4
+
+import argparse
+import concurrent.futures
+import gzip
+import hashlib
+import os
+import os.path
+import shutil
+from collections import defaultdict, namedtuple
+from pathlib import Path
+
+
+MANIFEST_NAME = '.tiles-manifest.gz'
+MANIFEST_HEADER = '# sync_tiles manifest v1'
+
+
+class ManifestEntry(namedtuple('ManifestEntry', 'path size mtime hash')):
+    # Types:
+    # path: str (relative to the tile directory, always using '/')
+    # size, mtime: int (mtime in nanoseconds)
+    # hash: str (hexadecimal digest)
+
+    def is_same_file(self, stat):
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build manifests of tile directories and sync only the changed tiles.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-P',
+        action='store',
+        default=0,
+        type=int,
+        dest='parallel_tasks',
+        help='Number of parallel hashing tasks'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('manifest', help='Build (or refresh) the manifest of a tile directory')
+    p.add_argument('tile_dir', action='store', type=str, help='Base directory of the tiles')
+    p.add_argument(
+        '-o',
+        action='store',
+        default=None,
+        type=str,
+        dest='output',
+        help='Manifest file (default: {0} inside tile_dir)'.format(MANIFEST_NAME)
+    )
+
+    p = subparsers.add_parser('diff', help='Print the differences between two manifests')
+    p.add_argument('old', action='store', type=str, help='Old manifest file')
+    p.add_argument('new', action='store', type=str, help='New manifest file')
+
+    p = subparsers.add_parser('sync', help='Copy only the new/changed tiles from src_dir into dst_dir')
+    p.add_argument('src_dir', action='store', type=str, help='Source tile directory')
+    p.add_argument('dst_dir', action='store', type=str, help='Destination tile directory')
+    p.add_argument(
+        '-o',
+        action='store',
+        default=None,
+        type=str,
+        dest='output',
+        help='Manifest file of dst_dir (default: {0} inside dst_dir, which is then also served by the web server)'.format(MANIFEST_NAME)
+    )
+    p.add_argument(
+        '-n', '--dry-run',
+        action='store_true',
+        dest='dry_run',
+        help='Only print what would be done'
+    )
+
+    options = parser.parse_args()
+
+    for attr in ['tile_dir', 'src_dir']:
+        d = getattr(options, attr, None)
+        if d is not None and not os.path.isdir(d):
+            parser.exit(u'Directory "{0}" not found'.format(d))
+
+    return options
+
+
+############################################################
+# Manifest reading, writing and building.
+
+def read_manifest(filename):
+    '''Returns the list of ManifestEntry stored in the file, sorted by path.'''
+    entries = []
+    with gzip.open(filename, 'rt', encoding='utf-8', newline='\n') as f:
+        header = f.readline().rstrip('\n')
+        if header != MANIFEST_HEADER:
+            raise ValueError('File "{0}" is not a tile manifest'.format(filename))
+        for line in f:
+            hash, size, mtime, path = line.rstrip('\n').split('\t', 3)
+            entries.append(ManifestEntry(path, int(size), int(mtime), hash))
+    return entries
+
+
+def write_manifest(filename, entries):
+    '''Writes the entries to the file, atomically replacing it.'''
+    tmp = filename + '.tmp'
+    # mtime=0 makes the output deterministic for the same entries.
+    with open(tmp, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as gz:
+            gz.write((MANIFEST_HEADER + '\n').encode('utf-8'))
+            for e in sorted(entries, key=lambda e: e.path):
+                gz.write('{e.hash}\t{e.size}\t{e.mtime}\t{e.path}\n'.format(e=e).encode('utf-8'))
+    os.replace(tmp, filename)
+
+
+def find_files(base_dir):
+    path = Path(base_dir)
+    for p in path.glob('**/*'):
+        if p.name.startswith(MANIFEST_NAME):
+            continue
+        if p.is_file():
+            yield p
+
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(str(filename), 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def build_manifest(base_dir, cached_entries=(), workers=None):
+    '''Returns the list of ManifestEntry for all files inside base_dir.
+
+    Files having the same size and mtime as in cached_entries are not hashed
+    again. All other files are hashed in parallel.
+    '''
+    cache = {e.path: e for e in cached_entries}
+    base = Path(base_dir)
+
+    entries = []
+    to_hash = []  # List of (relative path, stat)
+    for p in find_files(base):
+        rel = p.relative_to(base).as_posix()
+        stat = p.stat()
+        cached = cache.get(rel)
+        if cached is not None and cached.is_same_file(stat):
+            entries.append(cached)
+        else:
+            to_hash.append((rel, stat))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = executor.map(hash_file, (base / rel for rel, stat in to_hash))
+        for (rel, stat), hash in zip(to_hash, hashes):
+            entries.append(ManifestEntry(rel, stat.st_size, stat.st_mtime_ns, hash))
+
+    entries.sort(key=lambda e: e.path)
+    return entries
+
+
+def refresh_manifest(base_dir, manifest_file=None, workers=None):
+    '''Builds the manifest of base_dir, reusing and then updating the cached manifest file.'''
+    if manifest_file is None:
+        manifest_file = os.path.join(base_dir, MANIFEST_NAME)
+
+    cached_entries = []
+    if os.path.exists(manifest_file):
+        cached_entries = read_manifest(manifest_file)
+
+    entries = build_manifest(base_dir, cached_entries, workers)
+    if entries != cached_entries:
+        write_manifest(manifest_file, entries)
+    return entries
+
+
+############################################################
+# Diffing and applying.
+
+def diff_manifests(old, new):
+    '''Given two lists of ManifestEntry sorted by path, yields (status, old_entry, new_entry).
+
+    status is one of 'added', 'removed' or 'changed'. Unchanged files (same
+    path, size and hash) are not yielded.
+    '''
+    i = 0
+    j = 0
+    while i < len(old) and j < len(new):
+        a = old[i]
+        b = new[j]
+        if a.path == b.path:
+            if a.hash != b.hash or a.size != b.size:
+                yield ('changed', a, b)
+            i += 1
+            j += 1
+        elif a.path < b.path:
+            yield ('removed', a, None)
+            i += 1
+        else:
+            yield ('added', None, b)
+            j += 1
+    for a in old[i:]:
+        yield ('removed', a, None)
+    for b in new[j:]:
+        yield ('added', None, b)
+
+
+def _replace_with_copy(src, dst):
+    tmp = dst + '.sync_tiles.tmp'
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _replace_with_link(src, dst):
+    # Writing to a temporary name and then renaming it guarantees we never
+    # modify an inode that may be shared with other (unchanged) hard links.
+    tmp = dst + '.sync_tiles.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _prune_empty_dirs(base_dir, paths):
+    '''Removes the now-empty parent directories of paths (relative to base_dir), but never base_dir itself.'''
+    dirs = set()
+    for path in paths:
+        d = os.path.dirname(path)
+        while d:
+            dirs.add(d)
+            d = os.path.dirname(d)
+    # Deepest first, so that a directory is empty by the time we reach it.
+    for d in sorted(dirs, key=lambda d: d.count('/'), reverse=True):
+        try:
+            os.rmdir(os.path.join(base_dir, d))
+        except OSError:
+            # Not empty (or already gone).
+            pass
+
+
+def apply_diff(src_dir, dst_dir, src_entries, dst_entries, dry_run=False):
+    '''Makes dst_dir equal to src_dir, copying only new or changed unique blobs.
+
+    Returns the list of ManifestEntry describing dst_dir after the changes.
+    '''
+    diff = list(diff_manifests(dst_entries, src_entries))
+    touched = set()
+
+    # Grouping by contents, so that each unique blob is copied only once.
+    by_hash = defaultdict(list)
+    for status, old, new in diff:
+        if status == 'removed':
+            touched.add(old.path)
+        else:
+            touched.add(new.path)
+            by_hash[new.hash].append(new)
+
+    # Files already in the destination that can be reused as link sources.
+    existing = {}
+    for e in dst_entries:
+        if e.path not in touched:
+            existing.setdefault(e.hash, e.path)
+
+    removed = [old.path for status, old, new in diff if status == 'removed']
+    for path in removed:
+        print('Removing {0}'.format(path))
+        if not dry_run:
+            os.unlink(os.path.join(dst_dir, path))
+    if not dry_run:
+        # A directory may have been replaced by a file with the same name.
+        _prune_empty_dirs(dst_dir, removed)
+
+    written = []
+    for hash, group in by_hash.items():
+        if hash in existing:
+            source = os.path.join(dst_dir, existing[hash])
+            targets = group
+        else:
+            first = group[0]
+            source = os.path.join(dst_dir, first.path)
+            targets = group[1:]
+            print('Copying {0}'.format(first.path))
+            if not dry_run:
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                _replace_with_copy(os.path.join(src_dir, first.path), source)
+            written.append(first)
+
+        for e in targets:
+            print('Linking {0} to {1}'.format(e.path, os.path.relpath(source, dst_dir)))
+            if not dry_run:
+                target = os.path.join(dst_dir, e.path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                _replace_with_link(source, target)
+            written.append(e)
+
+    if dry_run:
+        return dst_entries
+
+    entries = [e for e in dst_entries if e.path not in touched]
+    for e in written:
+        stat = os.stat(os.path.join(dst_dir, e.path))
+        entries.append(e._replace(size=stat.st_size, mtime=stat.st_mtime_ns))
+    entries.sort(key=lambda e: e.path)
+    return entries
+
+
+############################################################
+# Command-line.
+
+def main():
+    options = parse_args()
+
+    workers = options.parallel_tasks
+    if workers <= 0:
+        workers = None
+
+    if options.command == 'manifest':
+        entries = refresh_manifest(options.tile_dir, options.output, workers)
+        print('{0} files, {1} unique.'.format(len(entries), len(set(e.hash for e in entries))))
+
+    elif options.command == 'diff':
+        old = read_manifest(options.old)
+        new = read_manifest(options.new)
+        for status, a, b in diff_manifests(old, new):
+            print('{0}\t{1}'.format(status, (b or a).path))
+
+    elif options.command == 'sync':
+        src_entries = refresh_manifest(options.src_dir, workers=workers)
+        if os.path.isdir(options.dst_dir):
+            dst_entries = refresh_manifest(options.dst_dir, options.output, workers)
+        else:
+            dst_entries = []
+            if not options.dry_run:
+                os.makedirs(options.dst_dir)
+
+        entries = apply_diff(options.src_dir, options.dst_dir, src_entries, dst_entries, options.dry_run)
+        if not options.dry_run:
+            write_manifest(options.output or os.path.join(options.dst_dir, MANIFEST_NAME), entries)
+
+    print('Finished!')
+
+if __name__ == '__main__':
+    main()
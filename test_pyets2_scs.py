@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Tests of the .scs archive reader of pyets2.py (ScsArchive, cityhash64 and
+# the virtual "foo.scs/bar" paths), using small synthetic archives.
+#
+# Usage:
+#   python3 -m pytest test_pyets2_scs.py
+#
+# Requirements:
+#   - Python 3.4
+#   - pytest
+
+import os.path
+import random
+import struct
+import zlib
+
+import pytest
+
+import pyets2
+from pyets2_benchmark import generate_ppd
+
+
+ROAD_LOOK_SII = b'''SiiNunit
+{
+road_look : road.look0 {
+\tname: "Road 1 lane double"
+\troad_size_left: 4.5
+}
+}
+'''
+
+PPD = generate_ppd(random.Random(1), curves=3, nodes=2)
+
+FILES = {
+    'def/world/road_look.sii': ROAD_LOOK_SII,
+    'prefab/a/p0.ppd': PPD,
+    'prefab/a/b/p1.ppd': PPD,
+    'map/europe/sec+0000+0000.base': struct.pack('<i', 825) + bytes(100),
+    'empty.txt': b'',
+    'big.bin': bytes(range(256)) * 1024,
+}
+
+
+@pytest.fixture(params=[
+    dict(compress=True, salt=0),
+    dict(compress=False, salt=0),
+    dict(compress=True, salt=123),
+], ids=['compressed', 'uncompressed', 'salted'])
+def archive_filename(request, tmpdir):
+    filename = str(tmpdir.join('base.scs'))
+    pyets2.write_scs_archive(filename, FILES, **request.param)
+    return filename
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'', 0x9ae16a3b2f90404f),
+    (b'prefab', 0x71f2fd8c0debbc87),
+    (b'def/world/road_look.sii', 0x018d10ca6f5ff898),
+])
+def test_cityhash64(data, expected):
+    assert pyets2.cityhash64(data) == expected
+
+
+@pytest.mark.parametrize('length, expected', [
+    # Covers each code path (0, 1-3, 4-8, 9-16, 17-32, 33-64 and >64 bytes).
+    (1, 0xbec09cc447469d8b),
+    (3, 0x40b4412e33eefd64),
+    (4, 0xf3c7ee05197a7b92),
+    (8, 0x0c97ecbc1e9d2626),
+    (9, 0xe51cf38098a5bfff),
+    (16, 0x7eda0ed8c837a168),
+    (17, 0xc9518fe63ebf6127),
+    (32, 0xa53f806f23a314e8),
+    (33, 0x0d861240f8a6c64b),
+    (64, 0x1ccefea99389ae75),
+    (65, 0xacf6a69f1f078342),
+    (128, 0x899e1a09acbba491),
+    (200, 0x6099c264b552b496),
+    (1000, 0x94a5db893804c92e),
+])
+def test_cityhash64_lengths(length, expected):
+    data = bytes((i * 7 + 3) % 256 for i in range(length))
+    assert pyets2.cityhash64(data) == expected
+
+
+def test_read(archive_filename):
+    with pyets2.ScsArchive(archive_filename) as archive:
+        for path, data in FILES.items():
+            assert archive.read(path) == data
+            assert archive.read('/' + path) == data
+        with archive.open('def/world/road_look.sii', 'r') as f:
+            assert f.read() == ROAD_LOOK_SII.decode('utf-8')
+        with pytest.raises(FileNotFoundError):
+            archive.read('missing.txt')
+
+
+def test_listdir(archive_filename):
+    with pyets2.ScsArchive(archive_filename) as archive:
+        assert sorted(archive.listdir('')) == ['*def', '*map', '*prefab', 'big.bin', 'empty.txt']
+        assert archive.listdir('prefab/a') == ['*b', 'p0.ppd']
+        assert archive.isdir('prefab/a/b')
+        assert not archive.isdir('prefab/a/p0.ppd')
+        with pytest.raises(NotADirectoryError):
+            archive.listdir('prefab/a/p0.ppd')
+
+
+def test_glob(archive_filename):
+    with pyets2.ScsArchive(archive_filename) as archive:
+        assert sorted(archive.glob('prefab/**/*.ppd')) == ['prefab/a/b/p1.ppd', 'prefab/a/p0.ppd']
+        assert archive.glob('prefab/*/*.ppd') == ['prefab/a/p0.ppd']
+        assert archive.glob('map/europe/sec*.base') == ['map/europe/sec+0000+0000.base']
+        assert archive.glob('missing/*.ppd') == []
+
+
+def test_salt(tmpdir):
+    filename = str(tmpdir.join('salted.scs'))
+    pyets2.write_scs_archive(filename, FILES, salt=123)
+    with pyets2.ScsArchive(filename) as archive:
+        assert archive.salt == 123
+        assert archive.hash_path('empty.txt') == pyets2.cityhash64(b'123empty.txt')
+        assert pyets2.cityhash64(b'empty.txt') not in archive.entries
+
+
+def test_encrypted_entry(tmpdir):
+    filename = str(tmpdir.join('encrypted.scs'))
+    pyets2.write_scs_archive(filename, {'secret.txt': b'secret'}, compress=False)
+
+    # Sets the Encrypted flag of the entry, in place.
+    with open(filename, 'r+b') as f:
+        data = bytearray(f.read())
+        magic, version, salt, hash_method, entry_count, entries_offset = pyets2.ScsArchive.StructHeader.unpack_from(data, 0)
+        for i in range(entry_count):
+            offset = entries_offset + i * pyets2.ScsEntry.Struct.size
+            entry = pyets2.ScsEntry(*pyets2.ScsEntry.Struct.unpack_from(data, offset))
+            if entry.hash == pyets2.cityhash64(b'secret.txt'):
+                entry = entry._replace(flags=entry.flags | pyets2.ScsEntryFlags.Encrypted)
+                pyets2.ScsEntry.Struct.pack_into(data, offset, *entry)
+        f.seek(0)
+        f.write(data)
+
+    with pyets2.ScsArchive(filename) as archive:
+        with pytest.raises(pyets2.ScsReadingException):
+            archive.read('secret.txt')
+
+
+def test_wrong_size(tmpdir):
+    filename = str(tmpdir.join('truncated.scs'))
+    pyets2.write_scs_archive(filename, {'a.txt': zlib.compress(b'x')}, compress=False)
+    with pyets2.ScsArchive(filename) as archive:
+        entry = archive.get_entry('a.txt')
+        archive.entries[entry.hash] = entry._replace(size=entry.size + 1)
+        with pytest.raises(pyets2.ScsReadingException):
+            archive.read('a.txt')
+
+
+def test_not_an_archive(tmpdir):
+    filename = str(tmpdir.join('not.scs'))
+    with open(filename, 'wb') as f:
+        f.write(b'PK\x03\x04' + bytes(100))
+    with pytest.raises(pyets2.ScsReadingException):
+        pyets2.ScsArchive(filename)
+
+
+def test_nested_archive(tmpdir):
+    # An archive inside a directory whose name also ends with .scs.
+    directory = tmpdir.mkdir('mods.scs').mkdir('x.scs')
+    filename = str(directory.join('base.scs'))
+    pyets2.write_scs_archive(filename, FILES)
+
+    assert pyets2.find_scs_archive(filename + '/prefab/a/p0.ppd') == (filename, 'prefab/a/p0.ppd')
+    assert pyets2.find_scs_archive(filename) == (None, filename)
+    assert pyets2.file_exists(filename + '/prefab/a/p0.ppd')
+    assert not pyets2.file_exists(filename + '/prefab/a')
+    assert pyets2.file_size(filename + '/big.bin') == len(FILES['big.bin'])
+    assert sorted(pyets2.glob_files(filename + '/prefab/**/*.ppd')) == [
+        filename + '/prefab/a/b/p1.ppd',
+        filename + '/prefab/a/p0.ppd',
+    ]
+
+
+def test_virtual_paths(archive_filename):
+    base = os.path.join(archive_filename, '')
+
+    items = list(pyets2.sii_file_reader(base + 'def/world/road_look.sii'))
+    assert [(x.type, x.name) for x in items] == [('road_look', 'road.look0')]
+    assert items[0].items['road_size_left'] == '4.5'
+
+    prefab = pyets2.Ets2Prefab(base + 'prefab/a/b/p1.ppd')
+    assert (len(prefab.curves), len(prefab.nodes)) == (3, 2)
+
+    sector = pyets2.Ets2Sector(base + 'map/europe/sec+0000+0000.base')
+    assert sector.version == 825
+
+
+def test_reopen_outdated(tmpdir):
+    filename = str(tmpdir.join('base.scs'))
+    pyets2.write_scs_archive(filename, {'a.txt': b'old'})
+    archive = pyets2.get_scs_archive(filename)
+    assert pyets2.get_scs_archive(filename) is archive
+
+    # Replaced (not overwritten), like a game update does.
+    pyets2.write_scs_archive(filename + '.tmp', {'a.txt': b'new contents'})
+    os.replace(filename + '.tmp', filename)
+    os.utime(filename, ns=(0, archive.file_signature[1] + 1))
+    assert archive.is_outdated()
+    new_archive = pyets2.get_scs_archive(filename)
+    assert new_archive is not archive
+    assert new_archive.read('a.txt') == b'new contents'
+
+
+def test_changed_files_in_archive(tmpdir, monkeypatch):
+    filename = str(tmpdir.join('base.scs'))
+    pyets2.write_scs_archive(filename, FILES)
+    monkeypatch.setattr(pyets2, 'BASE_SCS_DIR', filename)
+    monkeypatch.setattr(pyets2, 'DEF_SCS_DIR', filename)
+    mapper = pyets2.Ets2Mapper(lazy=True)
+    old_archive = mapper.scs_archives[filename]
+
+    files = dict(FILES)
+    files['prefab/a/p0.ppd'] = generate_ppd(random.Random(2), curves=3, nodes=2)
+    files['prefab/a/p2.ppd'] = PPD
+    pyets2.write_scs_archive(filename + '.tmp', files)
+    os.replace(filename + '.tmp', filename)
+    os.utime(filename, ns=(0, old_archive.file_signature[1] + 1))
+
+    # Another thread opening the new archive first must not matter.
+    pyets2.get_scs_archive(filename)
+    new_archive, changed = mapper._changed_files_in_archive(filename)
+    assert new_archive is pyets2.get_scs_archive(filename)
+    assert changed == [filename + '/prefab/a/p0.ppd', filename + '/prefab/a/p2.ppd']
+
+    new_mapper = mapper.reload_files([filename])
+    assert new_mapper.scs_archives[filename] is new_archive
+    assert mapper.scs_archives[filename] is old_archive
+    assert len(new_mapper.prefab_files) == 3